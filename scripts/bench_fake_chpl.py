@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+# A stand-in for the 'chpl' compiler, used by bench_pipeline.py so that the
+# blog pipeline can be benchmarked without a Chapel installation.
+#
+# "Compiling" a program writes a shell script that prints deterministic output
+# derived from the source: for every 'writeln' in the program, one line,
+# with a __BREAK__ line wherever the program prints one. Set
+# BENCH_CHPL_COMPILE_SECONDS to simulate compile time.
+
+import hashlib
+import os
+import re
+import sys
+import time
+
+VERSION = "chpl version 2.5.0 (benchmark stand-in)"
+
+def program_output(source):
+    lines = []
+    for (line_no, line) in enumerate(source.splitlines(), start=1):
+        if 'writeln("__BREAK__")' in line:
+            lines.append("__BREAK__")
+        elif re.search(r'\bwriteln\(', line):
+            digest = hashlib.sha256(line.encode()).hexdigest()[:16]
+            lines.append("line {}: {}".format(line_no, digest))
+    return lines
+
+def main(argv):
+    if "--version" in argv:
+        print(VERSION)
+        return 0
+
+    source_file = None
+    output_file = "a.out"
+    i = 0
+    while i < len(argv):
+        if argv[i] == "-o":
+            output_file = argv[i + 1]
+            i += 1
+        elif argv[i].endswith(".chpl"):
+            source_file = argv[i]
+        i += 1
+
+    if source_file is None:
+        print("error: no source file given", file=sys.stderr)
+        return 1
+
+    with open(source_file) as f:
+        lines = program_output(f.read())
+
+    time.sleep(float(os.environ.get("BENCH_CHPL_COMPILE_SECONDS", "0")))
+
+    with open(output_file, "w") as f:
+        f.write("#!/bin/sh\n")
+        f.write("cat <<'BENCH_EOF'\n")
+        f.write("".join(line + "\n" for line in lines))
+        f.write("BENCH_EOF\n")
+        f.write('echo "execopts: $*"\n')
+    os.chmod(output_file, 0o755)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the blog build pipeline: chpl2md conversion, chunk and
+# Markdown generation in chpl_blog.py, and insert_links.py. Each stage runs in
+# isolation against a synthetic corpus, with bench_fake_chpl.py standing in
+# for the Chapel compiler, and the timings are written out as JSON so that
+# they can be compared between commits.
+#
+# The chpl2md and chpl_blog stages still need CHPL_HOME to point at a Chapel
+# checkout, since that's where the literate Chapel parser lives; they are
+# reported as skipped when it isn't available.
+
+import argparse
+import contextlib
+import hashlib
+import html
+import io
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+WORDS = ["chapel", "locale", "domain", "array", "forall", "iterator",
+         "distribution", "parallel", "task", "record", "class", "module",
+         "reduction", "scan", "promotion", "generic", "sync", "atomic",
+         "performance", "compiler", "runtime", "program", "output", "blog"]
+
+IDENTIFIERS = ["writeln", "min", "max", "abs", "sqrt", "here", "Locales",
+               "numLocales", "dmapped", "blockDist"]
+
+### Corpus generation
+
+def sentence(rng):
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+    return " ".join(words).capitalize() + "."
+
+def prose_block(rng, lines, with_code_block):
+    block = []
+    for _ in range(lines):
+        block.append(sentence(rng))
+    if with_code_block:
+        # Code blocks inside prose aren't compiled, but they do go through
+        # the Markdown and HTML pipeline.
+        block += ["", "```Chapel", "proc notCompiled() {", "  writeln(42);", "}", "```"]
+    return ["/* " + block[0]] + ["   " + line if line else "" for line in block[1:]] + ["*/"]
+
+def code_block(rng, section, lines, anchors):
+    block = []
+    for i in range(lines):
+        var = "x{}_{}".format(section, i)
+        kind = rng.random()
+        if kind < 0.4:
+            line = 'writeln("{} = ", {});'.format(var, rng.randint(0, 1000))
+        elif kind < 0.7:
+            line = "var {} = {}({}, {});".format(var, rng.choice(["min", "max"]),
+                                                 rng.randint(0, 100), rng.randint(0, 100))
+        else:
+            line = "forall i in 1..{} do {}[i] = i * {};".format(
+                rng.randint(2, 50), var, rng.randint(1, 9))
+        if anchors and rng.random() < 0.1:
+            line += ' // hugo-tag="tag-{}-{}"'.format(section, i)
+        block.append(line)
+    return block
+
+def generate_post(rng, index, args):
+    prose_ratio = rng.uniform(0.2, 0.8)
+    sections = rng.randint(args.min_sections, args.max_sections)
+    breaks = rng.randint(0, min(sections, args.max_breaks))
+    break_sections = set(rng.sample(range(sections), breaks))
+
+    lines = ["// Synthetic post {}".format(index),
+             '// tags: ["Benchmark"]',
+             '// authors: ["Benchmark Suite"]',
+             "// date: 2024-01-01",
+             ""]
+    for section in range(sections):
+        section_lines = rng.randint(4, 30)
+        prose_lines = max(1, int(section_lines * prose_ratio))
+        code_lines = max(1, section_lines - prose_lines)
+        lines += prose_block(rng, prose_lines, rng.random() < args.code_block_ratio)
+        lines += code_block(rng, section, code_lines, args.anchors)
+        if section in break_sections:
+            lines.append('writeln("__BREAK__");')
+        lines.append("")
+
+    # Some posts get a matrix of compile and execution options.
+    compopts = execopts = None
+    if rng.random() < args.option_ratio:
+        compopts = ["--fast", "--no-checks"][:rng.randint(1, 2)]
+        execopts = ["--n={}".format(n) for n in range(1, rng.randint(2, 4))]
+    return "\n".join(lines) + "\n", compopts, execopts
+
+def generate_corpus(root, args):
+    rng = random.Random(args.seed)
+    src_dir = os.path.join(root, "chpl-src")
+    os.makedirs(src_dir)
+    stats = { "files": args.files, "lines": 0, "breaks": 0, "with_options": 0 }
+    for index in range(args.files):
+        source, compopts, execopts = generate_post(rng, index, args)
+        base = os.path.join(src_dir, "post{}".format(index))
+        with open(base + ".chpl", "w") as f:
+            f.write(source)
+        if compopts is not None:
+            stats["with_options"] += 1
+            with open(base + ".compopts", "w") as f:
+                f.write("\n".join(compopts) + "\n")
+            with open(base + ".execopts", "w") as f:
+                f.write("\n".join(execopts) + "\n")
+        stats["lines"] += source.count("\n")
+        stats["breaks"] += source.count('writeln("__BREAK__")')
+    return stats
+
+def highlight_line(line):
+    # Roughly what Hugo's syntax highlighter produces for a line of code.
+    spans = []
+    for token in re.findall(r'\w+|\s+|[^\w\s]', line):
+        if token.isspace():
+            spans.append(token)
+            continue
+        cls = "nx" if token[0].isalpha() else "p"
+        spans.append('<span class="{}">{}</span>'.format(cls, html.escape(token)))
+    return '<span class="line"><span class="cl">{}\n</span></span>'.format("".join(spans))
+
+def generate_html(root, args):
+    # Pages as Hugo would render them, their Chapel files, and an up-to-date
+    # link cache entry for each, so that insert_links.py can run without
+    # chapel-py.
+    rng = random.Random(args.seed + 1)
+    cache = {}
+    pages = []
+    for index in range(args.files):
+        post_dir = os.path.join(root, "public", "posts", "post{}".format(index))
+        os.makedirs(post_dir)
+        code_path = "code/post{}.chpl".format(index)
+        references = []
+        body = []
+        source = []
+        start_line = 1
+        for section in range(rng.randint(args.min_sections, args.max_sections)):
+            body.append("<p>{}</p>".format(" ".join(sentence(rng) for _ in range(5))))
+            code = code_block(rng, section, rng.randint(2, 20), False)
+            for (i, line) in enumerate(code):
+                for match in re.finditer(r'\w+', line):
+                    if match.group(0) in IDENTIFIERS:
+                        col = match.start() + 1
+                        references.append([[[start_line + i, col], [start_line + i, col + len(match.group(0))]],
+                                           "https://chapel-lang.org/docs/modules/standard/IO.html#IO." + match.group(0)])
+            body.append('<div class="highlight" data-code-type="main" data-code-path="{}" '
+                        'data-start-line="{}"><pre tabindex="0" class="chroma"><code class="language-chapel" '
+                        'data-lang="chapel">{}</code></pre></div>'.format(
+                            code_path, start_line, "".join(highlight_line(line) for line in code)))
+            source.extend(code + [""])
+            start_line += len(code) + 1
+        # Plenty of pages have no Chapel code at all.
+        if rng.random() < args.plain_page_ratio:
+            body = ["<p>{}</p>".format(sentence(rng)) for _ in range(40)]
+            references = []
+            source = []
+        os.makedirs(os.path.join(post_dir, "code"))
+        source_text = "".join(line + "\n" for line in source)
+        with open(os.path.join(post_dir, code_path), "w") as f:
+            f.write(source_text)
+        page = os.path.join(post_dir, "index.html")
+        with open(page, "w") as f:
+            f.write("<!DOCTYPE html>\n<html><head><title>Post {}</title></head><body>\n{}\n</body></html>\n"
+                    .format(index, "\n".join(body)))
+        pages.append(os.path.relpath(page, root))
+        references.sort(key=lambda x: x[0])
+        cache["public/posts/post{}/{}".format(index, code_path)] = {
+            "hash": hashlib.sha256(source_text.encode()).hexdigest(),
+            "references": references }
+    with open(os.path.join(root, "file-link-cache.json"), "w") as f:
+        json.dump(cache, f, indent=2)
+    return pages
+
+### Timing
+
+def summarize(times):
+    return { "runs": [round(t, 6) for t in times],
+             "min": round(min(times), 6),
+             "median": round(statistics.median(times), 6),
+             "mean": round(statistics.mean(times), 6) }
+
+def measure(fn, repeat, before=None):
+    times = []
+    for _ in range(repeat):
+        if before: before()
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return summarize(times)
+
+@contextlib.contextmanager
+def quiet():
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+@contextlib.contextmanager
+def working_directory(path):
+    old = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(old)
+
+def install_fake_chpl(root):
+    bin_dir = os.path.join(root, "bin")
+    os.makedirs(bin_dir)
+    os.symlink(os.path.join(SCRIPTS_DIR, "bench_fake_chpl.py"), os.path.join(bin_dir, "chpl"))
+    os.environ["PATH"] = bin_dir + os.pathsep + os.environ.get("PATH", "")
+
+### Stages
+
+def literate_chapel_missing():
+    if "CHPL_HOME" not in os.environ:
+        return "CHPL_HOME is not set; the literate Chapel parser is unavailable"
+    try:
+        import chpl2md
+    except ImportError as e:
+        return "chpl2md could not be imported: {}".format(e)
+    return None
+
+def bench_chpl2md(root, args):
+    import chpl2md
+    files = sorted(os.path.join("chpl-src", f) for f in os.listdir(os.path.join(root, "chpl-src"))
+                   if f.endswith(".chpl"))
+
+    def convert_all():
+        for f in files:
+            chpl2md.convert(f, "code/" + os.path.basename(f))
+
+    with working_directory(root):
+        results = { "cold": measure(convert_all, args.repeat, chpl2md._memo.clear) }
+        results["memoized"] = measure(convert_all, args.repeat)
+    return results
+
+def bench_chpl_blog(root, args):
+    import chpl_blog
+    import chpl2md
+
+    with working_directory(root), quiet():
+        chpl_blog.setup(chpl_blog.process_args(
+            ["build", "--no-output-cache", "--run-timeout", "60"]))
+        files = sorted(os.path.join("chpl-src", f) for f in os.listdir("chpl-src")
+                       if f.endswith(".chpl"))
+
+        def clean():
+            shutil.rmtree("content-gen", ignore_errors=True)
+            shutil.rmtree(".cache", ignore_errors=True)
+            chpl2md._memo.clear()
+            chpl_blog.manifest.clear()
+
+        def process_all():
+            for f in files:
+                chpl_blog.process_file(f)
+
+        results = {}
+        results["process_file"] = measure(process_all, args.repeat, clean)
+        results["generate_all_cold"] = measure(chpl_blog.generate_all, args.repeat, clean)
+        # Nothing changed since the last run, so this measures the cost of
+        # deciding that.
+        results["generate_all_unchanged"] = measure(chpl_blog.generate_all, args.repeat)
+    return results
+
+def bench_insert_links(root, args, pages):
+    pristine = os.path.join(root, "public-pristine")
+    shutil.copytree(os.path.join(root, "public"), pristine)
+
+    def reset():
+        shutil.rmtree(os.path.join(root, "public"))
+        shutil.copytree(pristine, os.path.join(root, "public"))
+
+    def run():
+        subprocess.run([sys.executable, os.path.join(SCRIPTS_DIR, "insert_links.py")] + pages,
+                       cwd=root, check=True, stdout=subprocess.DEVNULL)
+
+    return { "all_pages": measure(run, args.repeat, reset) }
+
+### Driver
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SCRIPTS_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline_path, threshold):
+    # Report stages whose median got slower than 'threshold' times the
+    # baseline's, returning whether any did.
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    regressed = False
+    for (stage, measurements) in results["stages"].items():
+        for (name, current) in measurements.items():
+            old = baseline.get("stages", {}).get(stage, {}).get(name)
+            if not isinstance(current, dict) or not isinstance(old, dict) or "median" not in old:
+                continue
+            ratio = current["median"] / old["median"] if old["median"] else float("inf")
+            marker = ""
+            if ratio > threshold:
+                marker = "  <-- slower"
+                regressed = True
+            print("{}/{}: {:.4f}s -> {:.4f}s ({:.2f}x){}".format(
+                stage, name, old["median"], current["median"], ratio, marker), file=sys.stderr)
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the blog build pipeline on a synthetic corpus.")
+    parser.add_argument('--files', type=int, default=40, help='Number of synthetic posts to generate')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for the corpus')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs per measurement')
+    parser.add_argument('--min-sections', type=int, default=3, help='Minimum prose/code sections per post')
+    parser.add_argument('--max-sections', type=int, default=15, help='Maximum prose/code sections per post')
+    parser.add_argument('--max-breaks', type=int, default=6, help='Maximum __BREAK__ outputs per post')
+    parser.add_argument('--option-ratio', type=float, default=0.25, help='Fraction of posts with .compopts/.execopts')
+    parser.add_argument('--code-block-ratio', type=float, default=0.2, help='Fraction of prose blocks with an embedded code block')
+    parser.add_argument('--plain-page-ratio', type=float, default=0.3, help='Fraction of HTML pages with no Chapel code')
+    parser.add_argument('--no-anchors', dest='anchors', action='store_false', help='Do not add hugo-tag anchors')
+    parser.add_argument('--stages', default='chpl2md,chpl_blog,insert_links', help='Comma-separated stages to run')
+    parser.add_argument('--keep', action='store_true', help='Keep the generated corpus and print its location')
+    parser.add_argument('-o', '--output', default='bench-results.json', help='Where to write the JSON results')
+    parser.add_argument('--compare', metavar='BASELINE', help='Compare against an earlier results file')
+    parser.add_argument('--threshold', type=float, default=1.2, help='Slowdown ratio that --compare reports as a regression')
+    args = parser.parse_args()
+    stages = args.stages.split(",")
+
+    root = tempfile.mkdtemp(prefix="chpl-blog-bench-")
+    try:
+        corpus = generate_corpus(root, args)
+        pages = generate_html(root, args)
+        install_fake_chpl(root)
+
+        results = { "meta": { "revision": git_revision(),
+                              "python": platform.python_version(),
+                              "platform": platform.platform(),
+                              "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                              "repeat": args.repeat },
+                    "corpus": dict(corpus, pages=len(pages), seed=args.seed),
+                    "stages": {} }
+
+        missing = literate_chapel_missing()
+        for stage in stages:
+            print("Running stage", stage, file=sys.stderr)
+            if stage in ("chpl2md", "chpl_blog") and missing:
+                results["stages"][stage] = { "skipped": missing }
+            elif stage == "chpl2md":
+                results["stages"][stage] = bench_chpl2md(root, args)
+            elif stage == "chpl_blog":
+                results["stages"][stage] = bench_chpl_blog(root, args)
+            elif stage == "insert_links":
+                results["stages"][stage] = bench_insert_links(root, args, pages)
+            else:
+                parser.error("unknown stage '{}'".format(stage))
+    finally:
+        if args.keep:
+            print("Corpus kept in", root, file=sys.stderr)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("Wrote results to", args.output, file=sys.stderr)
+
+    if args.compare and compare(results, args.compare, args.threshold):
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import functools
+import glob
+import hashlib
+import json
+import os
+import threading
+import output_cache
+from common import hash_file, write_file_atomically
+
+# Records the inputs that each generated post in content-gen was built from,
+# so that chpl_blog.py only has to regenerate posts whose inputs changed.
+# Posts with program output also depend on the compiler and the CHPL_*
+# environment it ran in.
+
+MANIFEST_PATH = os.path.join(".cache", "build-manifest.json")
+
+def hash_input(path):
+    try:
+        return hash_file(path)
+    except OSError:
+        return None
+
+# The scripts that turn a source into Markdown and chunks.
+GENERATOR_SCRIPTS = ["chpl2md.py", "chpl_blog.py", "common.py", "program_runner.py"]
+
+@functools.cache
+def generator_version():
+    # The generated content depends on the generating scripts themselves, so
+    # an edit to any of them invalidates every post. They're hashed by path
+    # rather than imported: chpl_blog.py is usually running as __main__.
+    # literate_chapel comes with Chapel, so it's found by importing it.
+    import literate_chapel
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    h = hashlib.sha256()
+    paths = [os.path.join(scripts_dir, name) for name in GENERATOR_SCRIPTS]
+    for path in paths + [literate_chapel.__file__]:
+        h.update((hash_input(path) or '').encode())
+    return h.hexdigest()
+
+def post_inputs(file):
+    base_name = file.removesuffix(".chpl")
+    paths = [file, base_name + ".compopts", base_name + ".execopts"]
+    paths += glob.glob(glob.escape(base_name) + ".good*")
+    paths += glob.glob(glob.escape(base_name) + ".*.good*")
+    return { path: hash_input(path) for path in sorted(set(paths))
+             if os.path.exists(path) }
+
+class BuildManifest:
+    def __init__(self, path=MANIFEST_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def entry_for(self, file, chunks):
+        entry = { 'inputs': post_inputs(file),
+                  'generator': generator_version(),
+                  'chunks': chunks }
+        if chunks:
+            entry['chpl_version'] = output_cache.chpl_version()
+            entry['env'] = dict(output_cache.relevant_env())
+        return entry
+
+    def is_current(self, file, entry, file_output_dir):
+        # If the generated post went missing (e.g. 'make clobber'), the
+        # recorded entry is meaningless.
+        if not os.path.exists(os.path.join(file_output_dir, "index.md")):
+            return False
+        with self.lock:
+            return self.entries.get(file) == entry
+
+    def record(self, file, entry):
+        with self.lock:
+            self.entries[file] = entry
+
+    def forget(self, file):
+        with self.lock:
+            self.entries.pop(file, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+
+    def save(self):
+        with self.lock:
+            towrite = json.dumps(self.entries, indent=2, sort_keys=True)
+        write_file_atomically(self.path, towrite)
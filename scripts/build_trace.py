@@ -0,0 +1,88 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from common import write_file_atomically
+
+# Opt-in tracing of where the blog scripts spend their time. Traces are
+# written in the Chrome trace event format, which can be opened with
+# chrome://tracing or https://ui.perfetto.dev.
+
+class Tracer:
+    def __init__(self, path, origin=None):
+        # Timestamps are microseconds since 'origin', a time.time() value
+        # (by default, when the tracer was made). Worker processes are given
+        # their parent's origin so that their events line up with its own.
+        self.path = path
+        self.pid = os.getpid()
+        self.origin = time.time() if origin is None else origin
+        self.offset = time.time() - self.origin
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.events = []
+        self.threads = set()
+
+    def _now_us(self):
+        # The wall clock is only read once; spans are timed with the
+        # monotonic perf_counter, as before.
+        return (self.offset + time.perf_counter() - self.start) * 1e6
+
+    def _thread(self):
+        # Name each thread once, so the viewer shows something friendlier
+        # than a thread id.
+        tid = threading.get_native_id()
+        if tid not in self.threads:
+            self.threads.add(tid)
+            self.events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                                 'tid': tid, 'args': { 'name': threading.current_thread().name } })
+        return tid
+
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        # The yielded dictionary can be used to attach more information (like
+        # exit statuses) to the span once it is known.
+        start = self._now_us()
+        try:
+            yield args
+        finally:
+            end = self._now_us()
+            with self.lock:
+                self.events.append({ 'name': name, 'cat': cat, 'ph': 'X',
+                                     'ts': round(start, 1), 'dur': round(end - start, 1),
+                                     'pid': self.pid, 'tid': self._thread(),
+                                     'args': args })
+
+    def take_events(self):
+        # Used to ship events recorded in a worker process back to the parent.
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def add_events(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def save(self):
+        with self.lock:
+            towrite = json.dumps({ 'traceEvents': self.events,
+                                   'displayTimeUnit': 'ms' })
+        write_file_atomically(self.path, towrite)
+
+class NullTracer:
+    @contextlib.contextmanager
+    def span(self, name, cat, **args):
+        yield args
+
+    def take_events(self):
+        return []
+
+    def add_events(self, events):
+        pass
+
+    def save(self):
+        pass
+
+def make_tracer(path):
+    return Tracer(path) if path else NullTracer()
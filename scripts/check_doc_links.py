@@ -1,14 +1,71 @@
 import argparse
+import concurrent.futures
 import json
-import functools
+import os
+import pathlib
 import urllib.parse
 from collections import defaultdict
-from requests import get
-from bs4 import BeautifulSoup
+import requests
+from requests.adapters import HTTPAdapter
+from common import write_file_atomically
+from doc_anchors import DOC_ROOT_URL, extract_ids
+
+HTTP_CACHE_PATH = os.path.join(".cache", "doc-link-pages.json")
+
+def load_http_cache(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        content = json.load(f)
+    return content if isinstance(content, dict) else {}
+
+def save_http_cache(path, cache):
+    write_file_atomically(path, json.dumps(cache, indent=1, sort_keys=True))
+
+def make_session(jobs):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def fetch_ids(session, url, cached, timeout):
+    # Returns (ids, cache entry) for the page at 'url'. Pages that haven't
+    # changed since they were last seen aren't downloaded (or parsed) again.
+    headers = {}
+    if cached:
+        if cached.get('etag'): headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'): headers['If-Modified-Since'] = cached['last_modified']
+
+    response = session.get(url, headers=headers, timeout=timeout)
+    if response.status_code == 304 and cached:
+        return (set(cached['ids']), cached)
+    response.raise_for_status()
+
+    ids = extract_ids(response.text)
+    entry = { 'etag': response.headers.get('ETag'),
+              'last_modified': response.headers.get('Last-Modified'),
+              'ids': sorted(ids) }
+    return (ids, entry)
+
+def read_local_ids(docs_dir, url):
+    # Offline mode: find the page in a local chpldoc build instead.
+    if not url.startswith(DOC_ROOT_URL):
+        raise ValueError("not under " + DOC_ROOT_URL)
+    path = pathlib.Path(docs_dir) / urllib.parse.unquote(url[len(DOC_ROOT_URL):])
+    return extract_ids(path.read_text(encoding='utf-8', errors='replace'))
 
 def main():
     parser = argparse.ArgumentParser(description="Check links generated by insert_links.py")
     parser.add_argument("cachefile", type=str, help="Path to the cache file containing links")
+    parser.add_argument("-j", "--jobs", type=int, default=16, help="Number of pages to fetch at once")
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds to wait for each page")
+    parser.add_argument("--http-cache", default=HTTP_CACHE_PATH,
+                        help="Where to remember page ETags, modification times and ids")
+    parser.add_argument("--no-http-cache", action="store_true", default=False,
+                        help="Always download every page")
+    parser.add_argument("--docs-dir", help="Check against a local chpldoc output tree instead of the network")
+    parser.add_argument("--docs-url", help="Fetch pages from this URL (e.g. a local server) instead of " + DOC_ROOT_URL)
     args = parser.parse_args()
     exit_code = 0
 
@@ -25,16 +82,42 @@ def main():
             canon_url = parsed.scheme + '://' + parsed.netloc + parsed.path
             url_fragments[canon_url].add(parsed.fragment)
 
-    for url, fragments in url_fragments.items():
-        page = get(url)
-        soup = BeautifulSoup(page.text, 'html.parser')
+    http_cache_path = None if args.no_http_cache or args.docs_dir else args.http_cache
+    http_cache = load_http_cache(http_cache_path)
+    session = make_session(args.jobs)
+
+    def page_ids(url):
+        if args.docs_dir:
+            return read_local_ids(args.docs_dir, url)
+
+        fetch_url = url
+        if args.docs_url and url.startswith(DOC_ROOT_URL):
+            fetch_url = args.docs_url.rstrip('/') + '/' + url[len(DOC_ROOT_URL):]
+        (ids, entry) = fetch_ids(session, fetch_url, http_cache.get(fetch_url), args.timeout)
+        http_cache[fetch_url] = entry
+        return ids
 
-        for fragment in fragments:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        results = { url: executor.submit(page_ids, url) for url in url_fragments }
+
+    # Report in a fixed order, regardless of which pages came back first.
+    for url in sorted(results):
+        try:
+            ids = results[url].result()
+        except (OSError, ValueError, requests.RequestException) as e:
+            print(f"Could not check {url}: {e}")
+            exit_code = 1
+            continue
+
+        for fragment in sorted(url_fragments[url]):
             if fragment == '': continue
-            if not soup.find(id=fragment):
+            if fragment not in ids:
                 print(f"Fragment '{fragment}' not found in {url}")
                 exit_code = 1
 
+    if http_cache_path is not None:
+        save_http_cache(http_cache_path, http_cache)
+
     exit(exit_code)
 
 if __name__ == "__main__":
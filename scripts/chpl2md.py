@@ -35,10 +35,14 @@ proc foo() {
 this comment will be text"""
 
 import os
+import io
 import re
 import sys
 import argparse
+import hashlib
 import itertools
+import threading
+from collections import OrderedDict
 from common import compute_options
 
 # Get access to the "Literate Chapel" script distributed with Chapel. To do
@@ -110,31 +114,36 @@ def extract_line_anchors(lines, line_no):
             new_lines.append(line_str)
     return (new_lines, anchors)
 
-def gen_md(pieces, chapelfile, **kwargs):
-    output = []
-    good_options = kwargs.get('options') or compute_options(chapelfile)
-    front_matter = []
-
-    first_code_idx = -1
-    last_code_idx = -1
+def strip_line_anchors(pieces):
+    """Remove anchor markers from the code pieces, in place, and return the
+    (tag, line) pairs they defined"""
+    anchors = []
     line_number = 1
-    code_indices = []
-    for (i, (kind, content)) in enumerate(pieces):
+    for (kind, content) in pieces:
         if kind != 'code':
             continue
-        code_indices.append(i)
-        new_content, anchors = extract_line_anchors(content, line_number)
+        new_content, piece_anchors = extract_line_anchors(content, line_number)
 
         # Modify content in place with procesed lines (which strip anchor markers)
         content[:] = new_content
-
-        # Push anchor markers before any content is in output to ensure they're
-        # always in scope. This way, you can refer to lines that are shown later
-        # as early as the first sentence of the prose.
-        for (tag, line) in anchors:
-            output.append(f'{{{{< mark_line_anchor tag="{tag}" line={line} >}}}}')
+        anchors.extend(piece_anchors)
 
         line_number += len(content) + 1;
+    return anchors
+
+def gen_md(pieces, chapelfile, **kwargs):
+    output = []
+    good_options = kwargs.get('options') or compute_options(chapelfile)
+    front_matter = []
+
+    first_code_idx = -1
+    last_code_idx = -1
+
+    # Push anchor markers before any content is in output to ensure they're
+    # always in scope. This way, you can refer to lines that are shown later
+    # as early as the first sentence of the prose.
+    for (tag, line) in strip_line_anchors(pieces):
+        output.append(f'{{{{< mark_line_anchor tag="{tag}" line={line} >}}}}')
 
     # Each line is md or code-block
     line_number = 1
@@ -176,7 +185,9 @@ def gen_code(pieces, chapelfile, **kwargs):
         elif kind == 'prose':
             pass
         elif kind == 'code':
-            content, _ = extract_line_anchors(content, 0)
+            # Pieces that already went through gen_md have no markers left.
+            if not kwargs.get('anchors_stripped'):
+                content, _ = extract_line_anchors(content, 0)
             output.append(content)
         elif kind == 'output':
             pass
@@ -204,15 +215,49 @@ def write(mdoutput, output):
     """Write to output"""
     sys.stdout.write(mdoutput)
 
+# Results of convert(), keyed on the file's contents and the conversion
+# settings, so that files which haven't changed aren't parsed again.
+MEMO_SIZE = 256
+_memo = OrderedDict()
+_memo_lock = threading.Lock()
+
+def convert(chapelfile, code_path=None, options=None):
+    """Parse chapelfile once and return both its markdown and its code"""
+    with open(chapelfile, 'rb') as handle:
+        data = handle.read()
+    options = options or compute_options(chapelfile)
+    key = (hashlib.sha256(data).hexdigest(), chapelfile, code_path,
+           tuple(tuple(option) for option in options))
+
+    with _memo_lock:
+        if key in _memo:
+            _memo.move_to_end(key)
+            return _memo[key]
+
+    pieces = to_pieces(io.StringIO(data.decode('utf-8'), newline=None), False)
+    mdoutput = gen_md(pieces, chapelfile, code_path=code_path, options=options)
+    codeoutput = gen_code(pieces, chapelfile, anchors_stripped=True)
+    result = (mdoutput, codeoutput)
+
+    with _memo_lock:
+        _memo[key] = result
+        if len(_memo) > MEMO_SIZE:
+            _memo.popitem(last=False)
+    return result
+
+def convert_files(chapelfiles, code_paths=None):
+    """Convert many files at once, returning {file: (markdown, code)}"""
+    code_paths = code_paths or {}
+    return { chapelfile: convert(chapelfile, code_paths.get(chapelfile))
+             for chapelfile in chapelfiles }
+
 def main_args(**kwargs):
     """Driver function - convert each file to md and write to output"""
     out = kwargs.get('out', sys.stdout)
     for chapelfile in kwargs['chapelfiles']:
-        with open(chapelfile, 'r', encoding='utf-8') as handle:
-            pieces = to_pieces(handle, False)
-            mdoutput = (gen_code if kwargs['code'] else gen_md)(pieces, chapelfile, **kwargs)
-
-        out.write(mdoutput)
+        mdoutput, codeoutput = convert(chapelfile, kwargs.get('code_path'),
+                                       kwargs.get('options'))
+        out.write(codeoutput if kwargs['code'] else mdoutput)
 
 def main():
     # Parse arguments and cast them into a dictionary
@@ -2,10 +2,10 @@
 import glob
 import os
 import pathlib
-import sys
 import tempfile
-import re
 import argparse
+import threading
+import time
 import watchdog.events
 import watchdog.observers
 import subprocess
@@ -13,17 +13,26 @@ import shutil
 import concurrent.futures
 from pathlib import Path
 from common import compute_options
+from build_manifest import BuildManifest
+from build_trace import make_tracer
+from job_scheduler import JobScheduler, DEFAULT_COMPILE_MEM_MB
+from program_runner import (BuildCancelled, ChunkWriter, check_cancelled,
+                            run_command, stream_program)
+import output_cache
+import program_runner
 import chpl2md
+import deploy
+import optimize_images
 
 input_dir = 'chpl-src'
 output_dir = "content-gen/posts"
 
-print("Deleting generated content folder {}".format(output_dir))
-shutil.rmtree(output_dir, ignore_errors=True)
+def output_dir_for(file):
+    base_name = os.path.basename(file).removesuffix(".chpl")
+    return output_dir + "/" + base_name
 
 def create_output_dir_for(file):
-    base_name = os.path.basename(file).removesuffix(".chpl")
-    file_output_dir = output_dir + "/" + base_name
+    file_output_dir = output_dir_for(file)
     # Create a path for the files. If we create the path for the code, the
     # folder above it will be created too.
     pathlib.Path(file_output_dir + "/code").mkdir(parents=True, exist_ok=True)
@@ -31,83 +40,304 @@ def create_output_dir_for(file):
 
 def generate_markdown(file, file_output_dir, options):
     base_name = os.path.basename(file).removesuffix(".chpl")
+    with tracer.span("markdown " + base_name, "markdown", file=file):
+        (mdoutput, codeoutput) = chpl2md.convert(file, f"code/{base_name}.chpl", options)
     with open(f"{file_output_dir}/index.md", "w") as f:
-        chpl2md.main_args(chapelfiles=[file], code=False, code_path=f"code/{base_name}.chpl", options=options, out=f)
+        f.write(mdoutput)
     with open(f"{file_output_dir}/code/{base_name}.chpl", "w") as f:
-        chpl2md.main_args(chapelfiles=[file], code=True, code_path=None, options=options, out=f)
-
-def generate_chunks_for_option(file, file_output_dir, tmpdir, option):
-    print("Processing option", option)
-    (suffix, compopt, execopt) = option
-    if suffix != '': suffix = '.' + suffix
+        f.write(codeoutput)
 
-    needs_output = False
-    with open(file) as f:
-        if "__BREAK__" in f.read():
-            needs_output = True
+def cached_output(file, compopt, execopt):
+    cache = program_output_cache
+    key = cache.key_for(file, compopt, execopt) if cache else None
+    if key is None: return (None, None)
 
-    if not needs_output: return
+    text = cache.get(key)
+    if text is not None:
+        print("Using cached output for", file, compopt, execopt)
+    return (key, text)
 
+def expected_output(file, suffix):
     base_name = os.path.basename(file).removesuffix(".chpl")
     good_file = os.path.dirname(file) + "/" + base_name + suffix + ".good"
     sample_file = good_file + ".sample"
 
     # If a .good or .good.sample file exists, no need to compile and run the
     # program.
-    if os.path.exists(sample_file):
-        with open(sample_file) as file:
-            text = file.read()
-    elif os.path.exists(good_file):
-        with open(good_file) as file:
-            text = file.read()
-    else:
-        os.system("chpl {} {} -o {}/prog".format(compopt, file, tmpdir))
-        os.system("{}/prog {} > {}/prog.out".format(tmpdir, execopt, tmpdir))
-        with open("{}/prog.out".format(tmpdir)) as file:
-            text = file.read()
-
-    chunks = re.split('^__BREAK__$', text, flags=re.MULTILINE)
-    for (i, chunk) in enumerate(chunks):
-        chunk_path = file_output_dir + "/output{}.{}".format(suffix, i)
-        if i > 0: chunk = chunk[1:] # remove leading newline
-        with open(chunk_path, "w") as chunkfile:
-            chunkfile.write(chunk)
-
-def generate_chunks(file, file_output_dir, options):
+    for path in [sample_file, good_file]:
+        if os.path.exists(path):
+            with open(path) as f:
+                return f.read()
+    return None
+
+def write_chunks(file_output_dir, suffix, text):
+    writer = ChunkWriter(file_output_dir, suffix)
+    writer.write_text(text)
+    writer.close()
+
+def generate_chunks_for_compopt(file, file_output_dir, tmpdir, compopt, options,
+                                expected_chunks, cancel):
+    # Options that can't be satisfied by a .good file or the output cache
+    # need the program to be run; they all share this compopt, so a single
+    # compile serves all of them. Returns whether every option's output is
+    # complete (it compiled, and the run wasn't stopped or cut off).
+    to_run = []
+    for option in options:
+        print("Processing option", option)
+        (suffix, _, execopt) = option
+        if suffix != '': suffix = '.' + suffix
+
+        text = expected_output(file, suffix)
+        key = None
+        if text is None:
+            (key, text) = cached_output(file, compopt, execopt)
+        if text is None:
+            to_run.append((suffix, execopt, key))
+            continue
+        write_chunks(file_output_dir, suffix, text)
+
+    if not to_run: return True
+
+    binary = tmpdir + "/prog"
+    check_cancelled(cancel)
+    def compile_program():
+        with tracer.span("compile " + file, "compile", file=file, compopt=compopt) as info:
+            info['status'] = run_command("chpl {} {} -o {}".format(compopt, file, binary),
+                                         cancel, usage=info)
+            return info['status']
+    compile_status = scheduler.compile(file, compopt, compile_program)
+
+    def run_option(suffix, execopt, key):
+        writer = ChunkWriter(file_output_dir, suffix,
+                             args.max_chunk_kb * 1024, args.max_output_mb * 1024 * 1024)
+        if compile_status != 0:
+            writer.close("compilation failed", expected_chunks)
+            return False
+
+        def run_program():
+            with tracer.span("run " + file, "run", file=file, compopt=compopt,
+                             execopt=execopt) as info:
+                info['status'] = stream_program("{} {}".format(binary, execopt), writer,
+                                                cancel, args.run_timeout or None, usage=info)
+                info['failure'] = writer.failure
+                return info['status']
+        try:
+            run_status = scheduler.run(file, compopt, execopt, run_program)
+        finally:
+            writer.close(expected_chunks=expected_chunks)
+        if writer.failure is not None:
+            print("Running {} {} failed: {}".format(file, execopt, writer.failure))
+
+        # Only remember complete output from programs that built and ran cleanly.
+        complete = writer.failure is None and not writer.truncated
+        if key is not None and run_status == 0 and complete:
+            program_output_cache.put(key, writer.text())
+        return complete
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(to_run)) as executor:
+        futures = [executor.submit(run_option, *run) for run in to_run]
+        return all([future.result() for future in futures])
+
+def generate_chunks(file, file_output_dir, options, cancel=None):
+    # Returns whether the output of every option is complete.
+    with open(file) as f:
+        breaks = f.read().count("__BREAK__")
+    if breaks == 0: return True
+
+    by_compopt = {}
+    for option in options:
+        by_compopt.setdefault(option[1], []).append(option)
+
+    complete = True
     with tempfile.TemporaryDirectory() as tmpdir:
-        for option in options:
-            generate_chunks_for_option(file, file_output_dir, tmpdir, option)
+        for (i, (compopt, compopt_options)) in enumerate(by_compopt.items()):
+            compopt_dir = tmpdir + "/" + str(i)
+            os.mkdir(compopt_dir)
+            if not generate_chunks_for_compopt(file, file_output_dir, compopt_dir,
+                                               compopt, compopt_options, breaks + 1, cancel):
+                complete = False
+    return complete
+
+def chunk_suffix(name):
+    # The option suffix of a chunk file ('' for output.0, '.1-2' for
+    # output.1-2.0), or None if 'name' isn't a chunk file.
+    parts = name.split(".")
+    if len(parts) < 2 or parts[0] != "output" or not parts[-1].isdigit():
+        return None
+    return "".join("." + part for part in parts[1:-1])
+
+def prune_chunks(file_output_dir, options):
+    # Remove chunks for options that no longer exist (e.g. after a line was
+    # deleted from the .execopts file).
+    suffixes = set('.' + suffix if suffix != '' else '' for (suffix, _, _) in options)
+    for name in os.listdir(file_output_dir):
+        suffix = chunk_suffix(name)
+        if suffix is not None and suffix not in suffixes:
+            os.remove(os.path.join(file_output_dir, name))
+
+def needs_chunks():
+    # we only generate external markdown for the link command, so no need for chunks
+    return not args.fast and args.command != 'link'
 
-def process_file(file):
+def process_file(file, cancel=None):
+    # Snapshot the inputs before reading them, so that an edit made while
+    # we're generating is picked up next time.
+    entry = manifest.entry_for(file, needs_chunks())
     options = compute_options(file)
     print("Options:", options)
     print("Creating directory for", file)
     file_output_dir = create_output_dir_for(file)
-    # we only generate external markdown for the link command, so no need for chunks
-    if not args.fast and args.command != 'link':
+    complete = True
+    if needs_chunks():
         print("Generating chunks for", file)
-        generate_chunks(file, file_output_dir, options)
+        with tracer.span("chunks " + file, "chunks", file=file):
+            complete = generate_chunks(file, file_output_dir, options, cancel)
+        prune_chunks(file_output_dir, options)
+    check_cancelled(cancel)
     print("Generating Markdown for", file)
     generate_markdown(file, file_output_dir, options)
+    if complete:
+        manifest.record(file, entry)
+    else:
+        # Leave a post with failed or cut-off output out of the manifest, so
+        # that the next build tries it again.
+        print("Output of {} is incomplete; it will be regenerated next time".format(file))
+        manifest.forget(file)
+
+def rebuild_file(file):
+    # Start from an empty directory, so nothing from the last build lingers.
+    # (The watcher rebuilds in place instead, so the page stays up, and
+    # relies on prune_chunks.)
+    shutil.rmtree(output_dir_for(file), ignore_errors=True)
+    process_file(file)
+
+def prune_deleted(files):
+    expected = set(os.path.basename(output_dir_for(file)) for file in files)
+    for file in list(manifest.entries):
+        if file not in files:
+            manifest.forget(file)
+            scheduler.forget(file)
+    if not os.path.isdir(output_dir): return
+    for name in os.listdir(output_dir):
+        if name not in expected:
+            print("Deleting generated content for removed file", name)
+            shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+
+def generate_all():
+    files = glob.glob(input_dir + "/*.chpl")
+    prune_deleted(files)
+    stale = [file for file in files
+             if not manifest.is_current(file, manifest.entry_for(file, needs_chunks()),
+                                        output_dir_for(file))]
+    print("Regenerating {} of {} files".format(len(stale), len(files)))
+    # Compiles and runs are throttled by the scheduler, so there need to be
+    # enough file workers to keep both kinds of job busy.
+    max_workers = scheduler.compile_jobs + scheduler.run_jobs
+    with tracer.span("generate", "phase", files=len(files), stale=len(stale)):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            executor.map(rebuild_file, scheduler.order(stale))
+    save_state()
+
+def save_state():
+    manifest.save()
+    scheduler.save()
+    tracer.save()
+
+COMPANION_SUFFIXES = [".good.sample", ".good", ".compopts", ".execopts"]
+
+def source_for(path):
+    # Map a changed file to the Chapel source it belongs to: the file itself,
+    # or the source for companion files like foo.good, foo.1-2.good or
+    # foo.compopts.
+    if path.endswith(".chpl"): return path
+    for suffix in COMPANION_SUFFIXES:
+        if not path.endswith(suffix): continue
+        base_name = path.removesuffix(suffix)
+        for candidate in [base_name, os.path.splitext(base_name)[0]]:
+            if os.path.exists(candidate + ".chpl"):
+                return candidate + ".chpl"
+    return None
+
+class RebuildQueue:
+    # Editors often fire several events for a single save, so instead of
+    # rebuilding on every event, wait until a file has been quiet for 'delay'
+    # seconds. A file that changes while it's being rebuilt has its rebuild
+    # cancelled, and is rebuilt again once things settle down.
+    def __init__(self, delay=0.3, workers=2):
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = {}
+        self.in_flight = {}
+        for _ in range(workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def request(self, file):
+        with self.cond:
+            self.pending[file] = time.monotonic() + self.delay
+            if file in self.in_flight:
+                self.in_flight[file].set()
+            self.cond.notify_all()
+
+    def _next_file(self):
+        # Called with the lock held; blocks until some file is due.
+        while True:
+            now = time.monotonic()
+            due = [(deadline, file) for (file, deadline) in self.pending.items()
+                   if file not in self.in_flight]
+            if due:
+                (deadline, file) = min(due)
+                if deadline <= now:
+                    del self.pending[file]
+                    return file
+                self.cond.wait(deadline - now)
+            else:
+                self.cond.wait()
+
+    def _work(self):
+        while True:
+            with self.cond:
+                file = self._next_file()
+                cancel = threading.Event()
+                self.in_flight[file] = cancel
+            try:
+                if os.path.exists(file):
+                    process_file(file, cancel)
+                    save_state()
+            except BuildCancelled:
+                print("Cancelled rebuild of", file)
+            except Exception as e:
+                print("Failed to rebuild {}: {}".format(file, e))
+            finally:
+                with self.cond:
+                    del self.in_flight[file]
+                    self.cond.notify_all()
 
 class ChapelFileHandler(watchdog.events.FileSystemEventHandler):
+    def __init__(self, queue):
+        self.queue = queue
+
+    def _changed(self, path, what):
+        file = source_for(path)
+        if file is None: return
+
+        print("File {}: {}".format(what, path))
+        self.queue.request(file)
+
     def on_created(self, event):
         if event.is_directory: return
-        file = event.src_path
-        if not file.endswith(".chpl"): return
-
-        print("File created:", file)
-        process_file(file)
+        self._changed(event.src_path, "created")
 
     def on_modified(self, event):
         if event.is_directory: return
-        file = event.src_path
-        if not file.endswith(".chpl"): return
+        self._changed(event.src_path, "modified")
 
-        print("File modified:", file)
-        process_file(file)
+    def on_moved(self, event):
+        # Some editors save by writing a temporary file and renaming it over
+        # the original.
+        if event.is_directory: return
+        self._changed(event.dest_path, "replaced")
 
-def process_args():
+def process_args(argv=None):
     parser = argparse.ArgumentParser(
             prog='generate_md',
             description='Run Hugo server for literate chapel')
@@ -119,6 +349,33 @@ def process_args():
                             help='Enable fast render mode, avoiding recompiling the program')
         parser.add_argument('-F', '--buildFuture', action='store_true',
                             help='Include content with publishdate in the future (forwarded to Hugo)')
+        parser.add_argument('--no-output-cache', action='store_true',
+                            help='Always recompile and rerun programs instead of reusing cached output')
+        parser.add_argument('--output-cache-dir', default=output_cache.DEFAULT_CACHE_DIR,
+                            help='Where to store cached program output')
+        parser.add_argument('--output-cache-max-mb', type=int, default=output_cache.DEFAULT_MAX_MB,
+                            help='Evict cached program output beyond this total size')
+        parser.add_argument('--output-cache-max-age', type=int, default=output_cache.DEFAULT_MAX_AGE_DAYS,
+                            help='Evict cached program output not used for this many days')
+        parser.add_argument('--compile-jobs', type=int,
+                            help='Maximum number of concurrent chpl compiles (default: a quarter of the cores)')
+        parser.add_argument('--run-jobs', type=int,
+                            help='Maximum number of concurrent program runs (default: one per core)')
+        parser.add_argument('--memory-budget-mb', type=int,
+                            help='Total memory available to concurrent compiles (default: 75%% of physical memory)')
+        parser.add_argument('--compile-mem-mb', type=int, default=DEFAULT_COMPILE_MEM_MB,
+                            help='Memory to reserve for each chpl compile')
+        parser.add_argument('--run-timeout', type=int, default=program_runner.DEFAULT_RUN_TIMEOUT,
+                            help='Stop programs that run for longer than this many seconds; 0 for no limit '
+                                 '(default: %(default)s, or $CHPL_BLOG_RUN_TIMEOUT if set)')
+        parser.add_argument('--max-chunk-kb', type=int, default=program_runner.DEFAULT_MAX_CHUNK_KB,
+                            help='Truncate each chunk of program output beyond this size')
+        parser.add_argument('--max-output-mb', type=int, default=program_runner.DEFAULT_MAX_OUTPUT_MB,
+                            help='Stop programs that print more than this much output')
+        parser.add_argument('--trace', metavar='FILE',
+                            help='Write a Chrome trace of where the build spends its time to FILE')
+        parser.add_argument('--clean', action='store_true',
+                            help='Regenerate all content from scratch instead of only changed files')
 
     subparsers = parser.add_subparsers(dest='command')
     serve_parser = subparsers.add_parser('serve')
@@ -126,7 +383,9 @@ def process_args():
     link_parser = subparsers.add_parser('link')
 
     build_parser.add_argument('-c', '--copy', action='store_true',
-                              help='Copy generated files into CHPL_WWW/blog')
+                              help='Copy new and changed generated files into CHPL_WWW/blog')
+    build_parser.add_argument('--optimize-images', action='store_true',
+                              help='Make smaller variants of post images for the figure shortcode (needs Pillow)')
 
     link_parser.add_argument('-a', '--article', help='The article for which to generate an external markdown file')
 
@@ -134,7 +393,7 @@ def process_args():
     add_common_args(serve_parser)
     add_common_args(build_parser)
 
-    return parser.parse_args()
+    return parser.parse_args(argv)
 
 def get_hugo_options(args):
     hugo_args = []
@@ -170,7 +429,7 @@ def start_hugo(options):
     return subprocess.Popen(hugo_args)
 
 def run_watcher():
-    event_handler = ChapelFileHandler()
+    event_handler = ChapelFileHandler(RebuildQueue())
     observer = watchdog.observers.Observer()
     observer.schedule(event_handler, input_dir, recursive=True)
     print("Starting filesystem watcher on dir:", input_dir)
@@ -182,32 +441,69 @@ def run_watcher():
         observer.stop()
         observer.join()
 
-args = process_args()
-options = get_hugo_options(args)
+def setup(parsed_args):
+    # Set up the state shared by the functions above. This is separate from
+    # main() so that other tools (like bench_pipeline.py) can drive them.
+    global args, program_output_cache, tracer, manifest, scheduler
+    args = parsed_args
+
+    program_output_cache = None
+    if not args.no_output_cache:
+        program_output_cache = output_cache.OutputCache(args.output_cache_dir,
+                                                        args.output_cache_max_mb,
+                                                        args.output_cache_max_age)
+        program_output_cache.evict()
+
+    tracer = make_tracer(args.trace)
+    manifest = BuildManifest()
+    scheduler = JobScheduler(args.compile_jobs, args.run_jobs,
+                             args.memory_budget_mb, args.compile_mem_mb)
+
+def main():
+    setup(process_args())
+    options = get_hugo_options(args)
+
+    if args.clean:
+        print("Deleting generated content folder {}".format(output_dir))
+        shutil.rmtree(output_dir, ignore_errors=True)
+        manifest.clear()
+
+    print("Creating initial Markdown and chunks for changed files")
+    generate_all()
+
+    if args.command == 'build':
+        print("Deleting Hugo output folder before re-generating")
+        shutil.rmtree('public', ignore_errors=True)
+
+        if args.optimize_images:
+            with tracer.span("images", "phase"):
+                optimize_images.optimize_all()
+
+        with tracer.span("hugo", "phase"):
+            generate_html(options).wait()
+
+        if args.copy:
+            www_dir = os.getenv('CHPL_WWW')
+            if www_dir is None:
+                raise Exception("CHPL_WWW not set; nowhere to copy files")
+            dest_dir = www_dir + '/chapel-lang.org/blog'
+            Path(dest_dir).mkdir(parents=True, exist_ok=True)
+            with tracer.span("copy", "phase", dest=dest_dir):
+                counts = deploy.deploy('public', dest_dir)
+            print("Copied {copied} files, hardlinked {linked}, deleted {deleted}; "
+                  "{unchanged} unchanged".format(**counts))
+        tracer.save()
+    elif args.command == 'link':
+        with tracer.span("hugo", "phase"):
+            generate_html(options).wait()
+        tracer.save()
+
+        shutil.copy(os.path.join('public', 'posts', args.article, 'index.md'), args.article + '.md')
+        print(args.article + '.md')
 
-print("Creating initial Markdown and chunks for all files")
-with concurrent.futures.ThreadPoolExecutor() as executor:
-    executor.map(process_file, glob.glob(input_dir + "/*.chpl"))
-
-if args.command == 'build':
-    print("Deleting Hugo output folder before re-generating")
-    shutil.rmtree('public', ignore_errors=True)
-
-    generate_html(options).wait()
-
-    if args.copy:
-        www_dir = os.getenv('CHPL_WWW')
-        if www_dir is None:
-            raise Exception("CHPL_WWW not set; nowhere to copy files")
-        dest_dir = www_dir + '/chapel-lang.org/blog'
-        Path(dest_dir).mkdir(parents=True, exist_ok=True)
-        shutil.copytree('public', dest_dir, dirs_exist_ok=True)
-elif args.command == 'link':
-    generate_html(options).wait()
-
-    shutil.copy(os.path.join('public', 'posts', args.article, 'index.md'), args.article + '.md')
-    print(args.article + '.md')
+    else:
+        start_hugo(options)
+        run_watcher()
 
-else:
-    start_hugo(options)
-    run_watcher()
+if __name__ == "__main__":
+    main()
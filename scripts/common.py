@@ -1,4 +1,6 @@
+import hashlib
 import os
+import tempfile
 
 def read_options_file(options_file):
     if not os.access(options_file, os.R_OK): return ['']
@@ -23,3 +25,37 @@ def compute_options(file):
     return [(str(i)+'-'+str(j), compopt, execopt)
             for (i, compopt) in enumerate(compopts, start=1)
             for (j, execopt) in enumerate(execopts, start=1)]
+
+def file_hasher(path):
+    # A sha256 object fed with the contents of 'path', for keys that also
+    # cover other inputs.
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h
+
+def hash_file(path):
+    return file_hasher(path).hexdigest()
+
+def write_file_atomically(path, contents):
+    # Write to a temporary file next to 'path' and rename it into place, so
+    # that concurrent readers (or writers) never see a partially-written file.
+    # 'contents' is either text or bytes.
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        if isinstance(contents, bytes):
+            f = os.fdopen(fd, 'wb')
+        else:
+            f = os.fdopen(fd, 'w', encoding='utf-8')
+        with f:
+            f.write(contents)
+        # mkstemp makes the file private, but some of these files are served
+        # by the web server.
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import fnmatch
+import json
+import os
+import shutil
+import tempfile
+from common import hash_file, write_file_atomically
+
+# Copies the built site into a web directory, touching only what changed:
+#
+#   ./scripts/deploy.py public $CHPL_WWW/chapel-lang.org/blog
+#
+# Every file under the source is hashed, and the hashes are compared with a
+# manifest of what the last deploy to the same destination wrote. New and
+# changed files are copied, files that are no longer built are deleted, and
+# files with identical contents (like the same code download linked from two
+# posts) are hardlinked to one another instead of being copied twice.
+#
+# A destination file is only trusted to be up to date if its size and
+# modification time are still what the last deploy left; anything else is
+# written again. Without a manifest for the destination (the first deploy,
+# say), the files already there are hashed instead.
+
+MANIFEST_PATH = os.path.join(".cache", "deploy-manifest.json")
+
+# test infrastructure that is copied into public/ along with the code, but
+# isn't part of the site
+EXCLUDE = [
+    "CLEANFILES", "*.tmp", "*.bad", "*.future", "*.compopts", "COMPOPTS",
+    "*.execopts", "EXECOPTS", "*.noexec", "sub_test", "*.notest", "*.skipif",
+    "PRECOMP", "*.numlocales", "*.suppressif", "Makefile", "NUMLOCALES",
+]
+
+def excluded(name):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in EXCLUDE)
+
+def list_files(root, source=True):
+    # Relative paths of the files under 'root'. Symlinks in the source are
+    # followed, so a link is deployed as a copy of (or hardlink to) its target.
+    paths = []
+    for (dirpath, dirnames, filenames) in os.walk(root, followlinks=source):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if source and excluded(name): continue
+            paths.append(os.path.relpath(os.path.join(dirpath, name), root))
+    return paths
+
+def hash_tree(root, paths, jobs):
+    # hashlib releases the GIL on large inputs, so threads are enough here.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        hashes = executor.map(lambda path: hash_file(os.path.join(root, path)), paths)
+        return dict(zip(paths, hashes))
+
+def load_manifests(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifests = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifests if isinstance(manifests, dict) else {}
+
+def stamp(path):
+    stat = os.lstat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def current_files(dest, recorded, jobs):
+    # Returns { path: hash } for the files in 'dest' that can be trusted to
+    # hold the given contents.
+    if recorded is None:
+        paths = [path for path in list_files(dest, source=False)
+                 if not os.path.islink(os.path.join(dest, path))]
+        return hash_tree(dest, paths, jobs)
+
+    current = {}
+    for (path, (file_hash, size, mtime_ns)) in recorded.items():
+        try:
+            if stamp(os.path.join(dest, path)) == [size, mtime_ns]:
+                current[path] = file_hash
+        except OSError:
+            pass
+    return current
+
+def place(make, target):
+    # Create the new file next to 'target' and rename it over the old one, so
+    # that other hardlinks to the old file are never modified.
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(target), suffix=".tmp")
+    os.close(fd)
+    os.remove(tmp_path)
+    try:
+        make(tmp_path)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def remove_empty_dirs(dest, path):
+    directory = os.path.dirname(path)
+    while directory:
+        try:
+            os.rmdir(os.path.join(dest, directory))
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+def deploy(source, dest, jobs=None, manifest_path=MANIFEST_PATH, verbose=False):
+    manifests = load_manifests(manifest_path)
+    key = os.path.realpath(dest)
+
+    wanted = hash_tree(source, list_files(source), jobs)
+    current = current_files(dest, manifests.get(key), jobs)
+
+    # a destination file with each hash that can be linked to
+    by_hash = {}
+    for (path, file_hash) in current.items():
+        if wanted.get(path) == file_hash:
+            by_hash.setdefault(file_hash, path)
+
+    counts = { 'copied': 0, 'linked': 0, 'deleted': 0, 'unchanged': 0 }
+    for (path, file_hash) in wanted.items():
+        target = os.path.join(dest, path)
+        if current.get(path) == file_hash:
+            counts['unchanged'] += 1
+            continue
+
+        action = 'copied'
+        if file_hash in by_hash:
+            existing = os.path.join(dest, by_hash[file_hash])
+            try:
+                place(lambda tmp: os.link(existing, tmp), target)
+                action = 'linked'
+            except OSError:
+                pass
+        if action == 'copied':
+            def copy(tmp, path=path):
+                shutil.copyfile(os.path.join(source, path), tmp)
+                shutil.copymode(os.path.join(source, path), tmp)
+            place(copy, target)
+            by_hash.setdefault(file_hash, path)
+        counts[action] += 1
+        if verbose: print(action, path)
+
+    for path in sorted((set(current) | set(manifests.get(key, {}))) - set(wanted)):
+        try:
+            os.remove(os.path.join(dest, path))
+        except FileNotFoundError:
+            continue
+        remove_empty_dirs(dest, path)
+        counts['deleted'] += 1
+        if verbose: print('deleted', path)
+
+    # Hardlinked files share a modification time, so every stamp is taken
+    # after all the files are in place.
+    manifests[key] = { path: [file_hash] + stamp(os.path.join(dest, path))
+                       for (path, file_hash) in sorted(wanted.items()) }
+    write_file_atomically(manifest_path, json.dumps(manifests, indent=1, sort_keys=True))
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy the built site into a web directory, updating only what changed")
+    parser.add_argument('source', help='The built site (usually public)')
+    parser.add_argument('dest', help='Where to deploy it (e.g. $CHPL_WWW/chapel-lang.org/blog)')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of files to hash at once')
+    parser.add_argument('--manifest', default=MANIFEST_PATH, help='Where to remember what was deployed')
+    parser.add_argument('-v', '--verbose', action='store_true', default=False, help='List every file written or deleted')
+    args = parser.parse_args()
+
+    counts = deploy(args.source, args.dest, args.jobs, args.manifest, args.verbose)
+    print("Deployed to {}: {copied} copied, {linked} hardlinked, {deleted} deleted, {unchanged} unchanged"
+          .format(args.dest, **counts))
+
+if __name__ == "__main__":
+    main()
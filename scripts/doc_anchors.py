@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import html.parser
+import json
+import os
+import pathlib
+import urllib.parse
+
+# An index of every page and anchor in a chpldoc HTML build, so that
+# insert_links.py can check the links it inserts without going to the
+# network. Build it with:
+#
+#   ./scripts/doc_anchors.py $CHPL_HOME/doc/html -o doc-anchors.json.gz
+
+DOC_ROOT_URL = "https://chapel-lang.org/docs/"
+
+class IdCollector(html.parser.HTMLParser):
+    # Much cheaper than building a whole BeautifulSoup tree when all we want
+    # is the set of ids on the page.
+    def __init__(self):
+        super().__init__()
+        self.ids = set()
+
+    def handle_starttag(self, tag, attrs):
+        for (name, value) in attrs:
+            if name == 'id' and value is not None:
+                self.ids.add(value)
+
+def extract_ids(text):
+    collector = IdCollector()
+    collector.feed(text)
+    collector.close()
+    return collector.ids
+
+def _page_ids(path):
+    return sorted(extract_ids(pathlib.Path(path).read_text(encoding='utf-8', errors='replace')))
+
+def build_index(docs_dir, jobs=None):
+    # Returns { page path relative to the docs root: sorted list of ids }.
+    pages = sorted(str(path.relative_to(docs_dir)) for path in pathlib.Path(docs_dir).rglob('*.html'))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        all_ids = executor.map(_page_ids, [os.path.join(docs_dir, page) for page in pages], chunksize=16)
+        return dict(zip(pages, all_ids))
+
+def save_index(path, index):
+    # Sorted and gzipped: the whole documentation compresses to well under
+    # a megabyte, and rebuilding from the same docs gives the same bytes.
+    data = json.dumps(index, sort_keys=True, separators=(',', ':')).encode()
+    with gzip.GzipFile(path, 'wb', mtime=0) as f:
+        f.write(data)
+
+class AnchorIndex:
+    def __init__(self, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            self.pages = { page: set(ids) for (page, ids) in json.load(f).items() }
+        self.hits = 0
+        self.misses = collections.Counter()
+
+    def check(self, url):
+        # Whether the page (and anchor, if any) 'url' points to exists. Links
+        # outside the documentation aren't ours to check.
+        if not url.startswith(DOC_ROOT_URL):
+            return True
+        parsed = urllib.parse.urlparse(url[len(DOC_ROOT_URL):])
+        ids = self.pages.get(urllib.parse.unquote(parsed.path))
+        if ids is not None and (not parsed.fragment or parsed.fragment in ids):
+            self.hits += 1
+            return True
+        self.misses[url] += 1
+        return False
+
+    def take_stats(self):
+        # Used to ship statistics from a worker process back to the parent.
+        stats = (self.hits, self.misses)
+        self.hits = 0
+        self.misses = collections.Counter()
+        return stats
+
+    def add_stats(self, stats):
+        (hits, misses) = stats
+        self.hits += hits
+        self.misses.update(misses)
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an index of the anchors in a chpldoc HTML tree")
+    parser.add_argument('docs_dir', help='Root of the chpldoc output (e.g. $CHPL_HOME/doc/html)')
+    parser.add_argument('-o', '--output', default='doc-anchors.json.gz', help='Where to write the index')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes to use')
+    args = parser.parse_args()
+
+    index = build_index(args.docs_dir, args.jobs)
+    save_index(args.output, index)
+    print("Indexed {} anchors in {} pages".format(sum(len(ids) for ids in index.values()), len(index)))
+
+if __name__ == "__main__":
+    main()
@@ -5,17 +5,23 @@ import bs4
 import os
 import collections
 import functools
+import importlib.metadata
 import bisect
 import json
 import re
+import concurrent.futures
+from build_trace import NullTracer, Tracer, make_tracer
+from doc_anchors import AnchorIndex
+from common import hash_file
+from link_index import LinkIndex
 
 BLOG_ROOT_PATH = pathlib.Path("https://chapel-lang.org/blog/")
 DOC_ROOT_PATH = pathlib.Path("https://chapel-lang.org/docs/")
 DOC_ROOT_URL = "https://chapel-lang.org/docs/"
 
-CACHE_DEST = "file-link-cache.json"
 # match abc.abc, not abc.def
 TYPE_CONSTRUCTOR_HEURISTIC = re.compile(r"([^.]+)\.\1$")
+IDENTIFIER = re.compile(r"\w+")
 
 def relative_to_docs(html_file, use_relative_links) -> str:
     if not use_relative_links:
@@ -39,16 +45,24 @@ class ReferenceContainer:
         # return the references in the range [start_index, end_index)
         return self.references[start_index:end_index]
 
-class CachedFile(ReferenceContainer):
-    def __init__(self, filepath, references):
+class CachedFile:
+    def __init__(self, filepath, lines):
+        # References from the link index, keyed by the line they start on.
         self.filepath = filepath
-        self.references = references
+        self.lines = lines
+
+    def applicable_links(self, start_line, end_line):
+        return [ref for line in range(start_line, end_line + 1)
+                    for ref in self.lines.get(line, [])]
+
+CHAPEL_PY_MISSING = "The Python bindings for the compiler front-end are needed to parse and analyze Chapel files."
 
 # The following code only works if chapel-py is installed. However, if we're
 # just using the cache, we don't need chapel-py at all.
 try:
     from chapel import each_matching
     from chapel.core import Context, Identifier, Dot, FnCall, Function, Module, NamedDecl, AggregateDecl
+    HAVE_CHAPEL_PY = True
 
 
     ### Copied / adjusted from https://chapel-lang.org/blog/posts/chapel-py/
@@ -166,6 +180,11 @@ try:
 
     ### End copied from chapel-py
 
+    def new_context():
+        ctx = Context()
+        ctx.set_module_paths([], [])
+        return ctx
+
     def _extract_location(node):
         if isinstance(node, Dot):
             return node.field_location()
@@ -173,6 +192,9 @@ try:
             return _extract_location(node.called_expression())
         return node.location()
 
+    def _in_standard_modules(fn):
+        return "modules" in pathlib.Path(fn.location().path()).parts
+
     def _resolve_call(call, via=None):
         rr = call.resolve_via(via) if via else call.resolve()
         if not rr:
@@ -192,16 +214,81 @@ try:
     #https://stackoverflow.com/questions/2912231/is-there-a-clever-way-to-pass-the-key-to-defaultdicts-default-factory
 
     class Instantiation:
-        def __init__(self, parent_file, sig, fn):
+        def __init__(self, sig, fn):
+            self.fn = fn
             self.references = []
-            self.parent_file = parent_file
+            # (sig, fn) pairs for the calls this instantiation makes
+            self.callees = []
 
             for (call, _) in each_matching(fn, set([FnCall, Dot])):
                 res = _resolve_call(call, sig)
                 if res is None: continue
                 other_sig, other_fn = res
                 self.references.append((_extract_location(call), other_fn))
-                parent_file.get_inst(other_sig, other_fn)
+                self.callees.append(res)
+
+    class InstantiationGraph:
+        # Instantiations hold AST nodes, so they only live for one file (the
+        # context may move to a new revision afterwards). What is kept across
+        # files is the set of standard module instantiations whose calls
+        # never leave the standard modules: a post only copies references
+        # from instantiations of its own functions, so later files can skip
+        # those entirely instead of walking them again. They are keyed by ID
+        # and signature text, which don't change between revisions for the
+        # standard modules.
+        def __init__(self):
+            self.standard_only = set()
+
+        def _shared_key(self, sig, fn, local_names):
+            # The key to share this instantiation between files under, or
+            # None if it can't be shared.
+            if not _in_standard_modules(fn): return None
+            text = str(sig)
+            # A signature that names one of the file's declarations may have
+            # been instantiated with one of its types, and another post can
+            # declare a different type with the same name.
+            if local_names.intersection(IDENTIFIER.findall(text)): return None
+            return (fn.unique_id(), text)
+
+        def reachable(self, roots, local_names):
+            # The instantiations needed by the (sig, fn) pairs in 'roots',
+            # apart from standard-only ones. Call chains can be arbitrarily
+            # deep, so this uses a worklist rather than recursion.
+            found = {}
+            shared_keys = {}
+            worklist = list(roots)
+            while worklist:
+                (sig, fn) = worklist.pop()
+                key = (fn.unique_id(), sig)
+                if key in found: continue
+                shared_key = self._shared_key(sig, fn, local_names)
+                if shared_key in self.standard_only: continue
+
+                inst = Instantiation(sig, fn)
+                found[key] = inst
+                shared_keys[key] = shared_key
+                worklist.extend(inst.callees)
+
+            self._remember(found, shared_keys)
+            return found.values()
+
+        def _remember(self, found, shared_keys):
+            # Start from every shareable instantiation and drop the ones that
+            # call something else until nothing changes, which keeps
+            # (mutually) recursive ones. Callees that aren't in 'found' were
+            # skipped above, so they are standard-only already.
+            keep = set(key for (key, shared_key) in shared_keys.items() if shared_key is not None)
+            changed = True
+            while changed:
+                changed = False
+                for key in list(keep):
+                    for (sig, fn) in found[key].callees:
+                        callee = (fn.unique_id(), sig)
+                        if callee in found and callee not in keep:
+                            keep.discard(key)
+                            changed = True
+                            break
+            self.standard_only.update(shared_keys[key] for key in keep)
 
     class ParsedFile(ReferenceContainer):
         def _collect_decls(self):
@@ -221,7 +308,7 @@ try:
                 if res is None: continue
                 sig, fn = res
                 self.references.append((_extract_location(call), fn))
-                self.get_inst(sig, fn)
+                self.called.append(res)
 
         def _process(self):
             for module in self.modules:
@@ -234,41 +321,34 @@ try:
             for module in self.modules:
                 self._process_resolve(module)
 
-        def get_inst(self, sig, fn):
-            if fn.unique_id() not in self.instantiations:
-                self.instantiations[fn.unique_id()] = {}
-
-            insts_for_sig = self.instantiations[fn.unique_id()]
-            if sig not in insts_for_sig:
-                # First, create the entry so that recursion doesn't break things
-                insts_for_sig[sig] = None
-                insts_for_sig[sig] = Instantiation(self, sig, fn)
-
-            return insts_for_sig[sig]
-
-        def __init__(self, filepath):
-            ctx = Context()
-            ctx.set_module_paths([], [])
+        def __init__(self, filepath, ctx=None, graph=None):
+            if ctx is None:
+                ctx = new_context()
+            if graph is None:
+                graph = InstantiationGraph()
 
             self.filepath = filepath
             self.references = []
             self.declarations = {}
-            self.instantiations = {}
+            self.called = []
             self.modules = ctx.parse(str(filepath))
 
             self._collect_decls()
             self._process()
 
+            instantiations = collections.defaultdict(list)
+            local_names = set(decl.name() for decl in self.declarations.values())
+            for inst in graph.reachable(self.called, local_names):
+                instantiations[inst.fn.unique_id()].append(inst)
+
             # for each function in this file that has a single instantiation,
             # copy its references too.
             for decl in self.declarations.values():
-                if decl.unique_id() in self.instantiations:
-                    insts = self.instantiations[decl.unique_id()]
-                    if len(insts) == 1:
-                        # this is a function with only one instantiation
-                        # copy its references to the current file
-                        for inst in insts.values():
-                            self.references.extend(inst.references)
+                insts = instantiations.get(decl.unique_id(), [])
+                if len(insts) == 1:
+                    # this is a function with only one instantiation
+                    # copy its references to the current file
+                    self.references.extend(insts[0].references)
 
             # Convert references to lists (which JSON can encode) and rule
             # out things without links.
@@ -284,135 +364,333 @@ try:
                 converted_references.append([[start, end], found_link])
             self.references = converted_references
             self.references.sort(key=lambda x: x[0])
+
+            # The context may move on to other files, which invalidates the
+            # AST; only the converted references are kept.
+            del self.modules, self.declarations, self.called
 except ImportError:
-    def ParsedFile(filepath):
-        raise ImportError("The Python bindings for the compiler front-end are needed to parse and analyze Chapel files.")
+    HAVE_CHAPEL_PY = False
 
+    def new_context():
+        raise ImportError(CHAPEL_PY_MISSING)
 
-def main():
-    parser = argparse.ArgumentParser(description="Insert links into HTML files that contain Chapel blocks.")
-    parser.add_argument('files', help='HTML files to post-process', nargs='+')
-    parser.add_argument('--regenerate-links', help='Re-run resolution in affected files to determine linked locations', action='store_true', default=False)
-    parser.add_argument('--use-relative-links', help='Assume documentation is at ../docs relative to the HTML root', action='store_true', default=False)
-    args = parser.parse_args()
+    def ParsedFile(filepath, ctx=None, graph=None):
+        raise ImportError(CHAPEL_PY_MISSING)
 
-    @functools.cache
-    def resolution_cache():
-        if os.path.exists(CACHE_DEST):
-            with open(CACHE_DEST, 'r', encoding='utf-8') as f:
-                content = json.load(f)
-                return content
-        return None
-
-    # Can't use functools cache here since we want to inspect the keys later
-    chpl_file_cache = dict()
-    def parse(filename):
-        nonlocal args, chpl_file_cache
-        filename_str = str(filename)
 
-        if filename_str in chpl_file_cache:
-            return chpl_file_cache[filename_str]
+@functools.cache
+def frontend_version():
+    # Recorded with each resolved file, so that links are re-resolved when
+    # the front-end (and so possibly its answers) changes.
+    try:
+        return importlib.metadata.version("chapel")
+    except importlib.metadata.PackageNotFoundError:
+        return "unknown"
+
+def is_current(stored_hash, stored_version, source_hash):
+    if not HAVE_CHAPEL_PY:
+        # We can't re-resolve anything, so entries from before hashes were
+        # recorded are trusted as they always were.
+        return stored_hash is None or stored_hash == source_hash
+    return stored_hash == source_hash and stored_version == frontend_version()
+
+class LinkInserter:
+    def __init__(self, index, regenerate_links, use_relative_links, tracer, share_context=True,
+                 anchors=None, keep_missing_anchors=False):
+        self.index = index
+        self.regenerate_links = regenerate_links
+        self.share_context = share_context
+        # An AnchorIndex to check links against before inserting them, if any
+        self.anchors = anchors
+        self.keep_missing_anchors = keep_missing_anchors
+        self.context = None
+        # Shared by every file this inserter resolves; see InstantiationGraph.
+        self.graph = None
+        self.use_relative_links = use_relative_links
+        self.tracer = tracer
+        self.current_dir = pathlib.Path(os.getcwd())
+        # Can't use functools cache here since we want to inspect the keys later
+        self.chpl_file_cache = dict()
+        self.resolved = dict()
+
+    def parse(self, filename):
+        filename_str = str(filename)
 
-        if not args.regenerate_links:
-            cached = resolution_cache()
-            if cached and filename_str in cached:
-                res = CachedFile(filename, cached[filename_str]['references'])
-                chpl_file_cache[filename_str] = res
+        if filename_str in self.chpl_file_cache:
+            return self.chpl_file_cache[filename_str]
+
+        try:
+            source_hash = hash_file(filename)
+        except OSError:
+            # Nothing to check the entry against (or to resolve).
+            source_hash = None
+        entry = self.index.lookup(filename_str)
+        if not self.regenerate_links or source_hash is None:
+            if entry is not None and (source_hash is None or is_current(entry[0], entry[1], source_hash)):
+                res = CachedFile(filename, entry[2])
+                self.chpl_file_cache[filename_str] = res
                 return res
-            return None
+            if not HAVE_CHAPEL_PY or source_hash is None:
+                # Links computed for an older version of the file would end
+                # up at the wrong places, so leave it without any.
+                if entry is not None:
+                    print("Warning: links for {} are out of date and were not inserted; "
+                          "install chapel-py to update them".format(filename_str))
+                self.chpl_file_cache[filename_str] = None
+                return None
 
-        res = ParsedFile(filename)
-        chpl_file_cache[filename_str] = res
+        # Only new or changed files get here, unless all links are being
+        # regenerated.
+        if self.graph is None:
+            self.graph = InstantiationGraph()
+        with self.tracer.span("resolve " + filename_str, "resolve", file=filename_str):
+            res = ParsedFile(filename, self._context(), self.graph)
+        self.chpl_file_cache[filename_str] = res
+        self.resolved[filename_str] = { 'hash': source_hash, 'version': frontend_version(),
+                                        'references': res.references }
         return res
 
-    current_dir = pathlib.Path(os.getcwd())
-    for html_file in args.files:
-        html = pathlib.Path(os.path.realpath(html_file))
-        html_folder = html.parent
-        soup = bs4.BeautifulSoup(html.read_text(), 'html.parser')
-        relative_doc_url = relative_to_docs(html_folder, args.use_relative_links)
-
-        # Collect all Chapel files, if any, used in this HTML file.
-        # Do not fetch key outside the loop so that if no Chapel files are found,
-        # the file is not in the dictionary.
-        for block in soup.find_all('div', attrs={'data-code-path': True}):
-            start_line = int(block['data-start-line'])
-            code_path = str(block['data-code-path'])
-            if not code_path.endswith(".chpl"):
-                continue
-            parsed = parse((html_folder / code_path).relative_to(current_dir))
-            if not parsed: continue
-
-            for idx, line in enumerate(block.find_all('span', attrs={'class': 'line'})):
-                cur_line = start_line + idx
-                cur_col = 1
-                links = parsed.applicable_links(cur_line, cur_line)
-                link_idx = 0
-
-                def check_position(text):
-                    nonlocal link_idx, cur_col
-                    # Advance past links that are before the current column
-                    while link_idx < len(links) and links[link_idx][0][1][1] < cur_col:
-                        link_idx += 1
-
-                    if link_idx >= len(links):
-                        return False
-
-                    cur_link = links[link_idx]
-                    if cur_col >= cur_link[0][0][1] and cur_col + len(text) <= cur_link[0][1][1]:
-                        return True
-
-                    return False
+    def _context(self):
+        # Resolving the standard modules dominates the cost of resolving a
+        # post, so by default one context is kept for every file this inserter
+        # resolves. Moving it to a new revision lets it reuse what it learned
+        # about the standard modules, while re-parsing the file. Nothing that
+        # holds AST nodes is kept across revisions, since posts reuse module
+        # names and their IDs would clash.
+        if not self.share_context:
+            return new_context()
+        if self.context is None:
+            self.context = new_context()
+        else:
+            self.context.advance_to_next_revision(False)
+        return self.context
 
-                def traverse(node):
-                    # if the whole node fits into a link, paint it directly,
-                    # and do not recurse
-                    nonlocal link_idx, cur_col
-                    text = node.text
-                    if check_position(text):
-                        doc_link = links[link_idx][1]
+    def take_resolved(self):
+        # Hand back the files resolved since the last call, for the cache.
+        resolved = self.resolved
+        self.resolved = dict()
+        return resolved
 
-                        if doc_link:
-                            doc_link = doc_link.replace(DOC_ROOT_URL, relative_doc_url + "/")
-                            node = node.wrap(soup.new_tag('a', href=doc_link))
+    def process(self, html_file):
+        with self.tracer.span("insert_links " + html_file, "insert_links", file=html_file):
+            self._process(html_file)
 
-                        cur_col += len(text)
-                        return
+    def _process(self, html_file):
+        html = pathlib.Path(os.path.realpath(html_file))
+        text = html.read_text(encoding='utf-8')
 
-                    # This string wasn't painted by anything, so just
-                    # advance the cursor and move on.
-                    if isinstance(node, bs4.element.NavigableString):
-                        cur_col += len(text)
-                        return
+        # Most pages have no Chapel code blocks; don't bother parsing those.
+        if 'data-code-path' not in text:
+            return
 
-                    # the whole node didn't fit, but one of its children might
-                    for child in node.children:
-                        traverse(child)
+        html_folder = html.parent
+        relative_doc_url = relative_to_docs(html_folder, self.use_relative_links)
+
+        # Only parse and re-serialize the code blocks themselves, and leave the
+        # rest of the page byte-for-byte as Hugo wrote it.
+        pieces = []
+        last_end = 0
+        for (start, end) in code_block_regions(text):
+            fragment = bs4.BeautifulSoup(text[start:end], 'html.parser')
+            block = fragment.find('div', attrs={'data-code-path': True})
+            if block is None: continue
+            if not self._link_block(block, fragment, html_folder, relative_doc_url):
+                continue
 
+            pieces.append(text[last_end:start])
+            pieces.append(str(fragment))
+            last_end = end
 
-                # walk each line, insert links where possible
-                traverse(line)
+        # Don't touch (or bump the modification time of) unchanged files.
+        if not pieces:
+            return
+        pieces.append(text[last_end:])
 
         # save the modified HTML file
         with open(html, 'w', encoding='utf-8') as f:
-            f.write(str(soup))
-
-    # Update entries in the cache if we are updating it
-    if args.regenerate_links:
-        cache = resolution_cache() or {}
-        if not isinstance(cache, dict):
-            cache = {}
-
-        for (path, result) in chpl_file_cache.items():
-            cache[str(path)] = { 'references': result.references }
+            f.write(''.join(pieces))
+
+    def _link_block(self, block, soup, html_folder, relative_doc_url):
+        # Returns the number of links added to the block.
+        links_added = 0
+        start_line = int(block['data-start-line'])
+        code_path = str(block['data-code-path'])
+        if not code_path.endswith(".chpl"):
+            return links_added
+        parsed = self.parse((html_folder / code_path).relative_to(self.current_dir))
+        if not parsed: return links_added
+
+        for idx, line in enumerate(block.find_all('span', attrs={'class': 'line'})):
+            cur_line = start_line + idx
+            cur_col = 1
+            links = parsed.applicable_links(cur_line, cur_line)
+            link_idx = 0
+
+            def check_position(text):
+                nonlocal link_idx, cur_col
+                # Advance past links that are before the current column
+                while link_idx < len(links) and links[link_idx][0][1][1] < cur_col:
+                    link_idx += 1
+
+                if link_idx >= len(links):
+                    return False
 
-        # https://stackoverflow.com/a/72611442
-        towrite = json.dumps(cache, indent=2, ensure_ascii=False)
-        pat = re.compile(f'\n(  ){{3}}((  )+|(?=(}}|])))')
-        towrite = pat.sub('', towrite)
+                cur_link = links[link_idx]
+                if cur_col >= cur_link[0][0][1] and cur_col + len(text) <= cur_link[0][1][1]:
+                    return True
+
+                return False
+
+            def traverse(node):
+                # if the whole node fits into a link, paint it directly,
+                # and do not recurse
+                nonlocal link_idx, cur_col, links_added
+                text = node.text
+                if check_position(text):
+                    doc_link = links[link_idx][1]
+                    if doc_link and self.anchors is not None:
+                        if not self.anchors.check(doc_link) and not self.keep_missing_anchors:
+                            doc_link = None
+
+                    if doc_link:
+                        doc_link = doc_link.replace(DOC_ROOT_URL, relative_doc_url + "/")
+                        node = node.wrap(soup.new_tag('a', href=doc_link))
+                        links_added += 1
+
+                    cur_col += len(text)
+                    return
+
+                # This string wasn't painted by anything, so just
+                # advance the cursor and move on.
+                if isinstance(node, bs4.element.NavigableString):
+                    cur_col += len(text)
+                    return
+
+                # the whole node didn't fit, but one of its children might
+                for child in node.children:
+                    traverse(child)
+
+
+            # walk each line, insert links where possible
+            traverse(line)
+
+        return links_added
+
+
+CODE_BLOCK_START = re.compile(r'<div\b[^>]*\sdata-code-path=', re.IGNORECASE)
+DIV_TAG = re.compile(r'<(/?)div\b[^>]*>', re.IGNORECASE)
+
+def code_block_regions(text):
+    # Yield the (start, end) offsets of each outermost <div> with a
+    # data-code-path attribute. Code inside is escaped, so counting <div> tags
+    # is enough to find where the block ends.
+    pos = 0
+    while (match := CODE_BLOCK_START.search(text, pos)) is not None:
+        depth = 0
+        end = None
+        for tag in DIV_TAG.finditer(text, match.start()):
+            depth += -1 if tag.group(1) else 1
+            if depth == 0:
+                end = tag.end()
+                break
+        if end is None:
+            return
+        yield (match.start(), end)
+        pos = end
+
+# Worker processes for --root (or many files) each get their own inserter.
+# The parent brings the link index up to date before starting them, so they
+# only ever read from it.
+_worker_inserter = None
+
+def _init_worker(regenerate_links, use_relative_links, trace_origin, share_context,
+                 anchor_index, keep_missing_anchors):
+    global _worker_inserter
+    # Events (and anchor statistics) are sent back to the parent, which
+    # reports them.
+    tracer = Tracer(None, trace_origin) if trace_origin is not None else NullTracer()
+    anchors = AnchorIndex(anchor_index) if anchor_index else None
+    _worker_inserter = LinkInserter(LinkIndex(), regenerate_links, use_relative_links,
+                                    tracer, share_context, anchors, keep_missing_anchors)
+
+def _process_in_worker(html_file):
+    _worker_inserter.process(html_file)
+    anchors = _worker_inserter.anchors
+    return (_worker_inserter.take_resolved(), _worker_inserter.tracer.take_events(),
+            anchors.take_stats() if anchors is not None else None)
+
+def report_anchor_stats(anchors, keep_missing_anchors, stats_file):
+    missed = sum(anchors.misses.values())
+    print("Checked {} links against the anchor index: {} found, {} missing{}".format(
+        anchors.hits + missed, anchors.hits, missed,
+        "" if keep_missing_anchors or not missed else " (not inserted)"))
+    for (url, count) in sorted(anchors.misses.items()):
+        print("  missing: {} ({} uses)".format(url, count))
+
+    if stats_file:
+        with open(stats_file, 'w', encoding='utf-8') as f:
+            json.dump({ 'hits': anchors.hits, 'misses': missed,
+                        'missing': dict(sorted(anchors.misses.items())) }, f, indent=2)
+
+def find_html_files(root):
+    return sorted(str(path) for path in pathlib.Path(root).rglob('*.html'))
 
-        with open(CACHE_DEST, 'w', encoding='utf-8') as f:
-            f.write(towrite)
+def main():
+    parser = argparse.ArgumentParser(description="Insert links into HTML files that contain Chapel blocks.")
+    parser.add_argument('files', help='HTML files to post-process', nargs='*')
+    parser.add_argument('--root', help='Post-process every HTML file under this directory')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes to use')
+    parser.add_argument('--regenerate-links', help='Re-run resolution in all affected files, even ones whose links are up to date', action='store_true', default=False)
+    parser.add_argument('--use-relative-links', help='Assume documentation is at ../docs relative to the HTML root', action='store_true', default=False)
+    parser.add_argument('--no-shared-context', help='Resolve each Chapel file in a fresh front-end context', action='store_true', default=False)
+    parser.add_argument('--anchor-index', metavar='FILE', help='Only insert links to anchors listed in FILE (built with doc_anchors.py)')
+    parser.add_argument('--keep-missing-anchors', help='With --anchor-index, report links to missing anchors but still insert them', action='store_true', default=False)
+    parser.add_argument('--anchor-stats', metavar='FILE', help='With --anchor-index, write hit and miss counts to FILE as JSON')
+    parser.add_argument('--trace', metavar='FILE', help='Write a Chrome trace of where time is spent to FILE')
+    args = parser.parse_args()
+    tracer = make_tracer(args.trace)
+
+    html_files = list(args.files)
+    if args.root:
+        html_files += find_html_files(args.root)
+    if not html_files:
+        parser.error("no HTML files given; pass some files or --root")
+
+    index = LinkIndex()
+    with tracer.span("refresh link index", "insert_links"):
+        index.refresh()
+    resolved = dict()
+    share_context = not args.no_shared_context
+    anchors = AnchorIndex(args.anchor_index) if args.anchor_index else None
+
+    # Each process (this one, or each worker) keeps its own front-end context
+    # for all the Chapel files it resolves.
+    if args.jobs <= 1 or len(html_files) == 1:
+        inserter = LinkInserter(index, args.regenerate_links, args.use_relative_links,
+                                tracer, share_context, anchors, args.keep_missing_anchors)
+        for html_file in html_files:
+            inserter.process(html_file)
+        resolved = inserter.take_resolved()
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=args.jobs, initializer=_init_worker,
+                initargs=(args.regenerate_links, args.use_relative_links,
+                          tracer.origin if args.trace else None, share_context,
+                          args.anchor_index, args.keep_missing_anchors)) as executor:
+            for (file_resolved, events, anchor_stats) in executor.map(_process_in_worker, html_files, chunksize=4):
+                resolved.update(file_resolved)
+                tracer.add_events(events)
+                if anchor_stats is not None:
+                    anchors.add_stats(anchor_stats)
+
+    # Update entries in the index (and its export) for re-resolved files
+    index.update(resolved)
+    index.close()
+
+    if anchors is not None:
+        report_anchor_stats(anchors, args.keep_missing_anchors, args.anchor_stats)
+
+    tracer.save()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,127 @@
+import contextlib
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+from common import write_file_atomically
+
+# Schedules the compiles and program runs that chpl_blog.py performs while
+# generating chunks. Compiles are memory-hungry, while runs of the (small)
+# blog programs are not, so the two are limited separately. Work is handed
+# out longest-first, using how long each file took in previous builds.
+
+DURATIONS_PATH = os.path.join(".cache", "build-durations.json")
+DEFAULT_COMPILE_MEM_MB = 2048
+
+def default_compile_jobs():
+    return max(1, (os.cpu_count() or 1) // 4)
+
+def default_run_jobs():
+    return os.cpu_count() or 1
+
+def default_memory_budget_mb():
+    # Leave some headroom for Hugo, the OS, and everything else.
+    try:
+        total = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+    return total * 3 // 4 // (1024 * 1024)
+
+class PriorityGate:
+    def __init__(self, slots, memory=None):
+        self.cond = threading.Condition()
+        self.slots = slots
+        self.total_memory = memory
+        self.memory = memory
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def _fits(self, memory):
+        return self.slots > 0 and (self.memory is None or memory <= self.memory)
+
+    @contextlib.contextmanager
+    def acquire(self, priority=0, memory=0):
+        # A job that needs more than the whole budget still gets to run, just
+        # on its own.
+        if self.total_memory is not None:
+            memory = min(memory, self.total_memory)
+
+        # Waiters are served strictly in priority order (ties broken by
+        # arrival), so a large job isn't starved by a stream of smaller ones.
+        ticket = (-priority, next(self.counter))
+        with self.cond:
+            heapq.heappush(self.waiting, ticket)
+            while self.waiting[0] != ticket or not self._fits(memory):
+                self.cond.wait()
+            heapq.heappop(self.waiting)
+            self.slots -= 1
+            if self.memory is not None: self.memory -= memory
+            self.cond.notify_all()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.slots += 1
+                if self.memory is not None: self.memory += memory
+                self.cond.notify_all()
+
+class JobScheduler:
+    def __init__(self, compile_jobs=None, run_jobs=None, memory_budget_mb=None,
+                 compile_mem_mb=DEFAULT_COMPILE_MEM_MB, durations_path=DURATIONS_PATH):
+        self.compile_jobs = compile_jobs or default_compile_jobs()
+        self.run_jobs = run_jobs or default_run_jobs()
+        if memory_budget_mb is None:
+            memory_budget_mb = default_memory_budget_mb()
+        self.compiles = PriorityGate(self.compile_jobs, memory_budget_mb)
+        self.runs = PriorityGate(self.run_jobs)
+        self.compile_mem_mb = compile_mem_mb
+        self.durations_path = durations_path
+        self.lock = threading.Lock()
+        try:
+            with open(durations_path, encoding='utf-8') as f:
+                self.durations = json.load(f)
+        except (OSError, ValueError):
+            self.durations = {}
+
+    def expected_duration(self, file):
+        with self.lock:
+            file_durations = self.durations.get(file)
+            if not file_durations: return None
+            return sum(file_durations.values())
+
+    def priority(self, file):
+        # Files we've never timed might be the slowest of all, so start them
+        # early rather than discovering that at the end of the build.
+        expected = self.expected_duration(file)
+        return float('inf') if expected is None else expected
+
+    def order(self, files):
+        return sorted(files, key=self.priority, reverse=True)
+
+    def _timed(self, gate, memory, file, job, fn):
+        with gate.acquire(self.priority(file), memory):
+            start = time.monotonic()
+            result = fn()
+            elapsed = time.monotonic() - start
+        with self.lock:
+            self.durations.setdefault(file, {})[job] = round(elapsed, 3)
+        return result
+
+    def compile(self, file, compopt, fn):
+        return self._timed(self.compiles, self.compile_mem_mb, file,
+                           ("compile " + compopt).rstrip(), fn)
+
+    def run(self, file, compopt, execopt, fn):
+        return self._timed(self.runs, 0, file,
+                           "run " + compopt + " | " + execopt, fn)
+
+    def forget(self, file):
+        with self.lock:
+            self.durations.pop(file, None)
+
+    def save(self):
+        with self.lock:
+            towrite = json.dumps(self.durations, indent=2, sort_keys=True)
+        write_file_atomically(self.durations_path, towrite)
@@ -0,0 +1,141 @@
+import json
+import os
+import re
+import sqlite3
+from common import write_file_atomically
+
+# An indexed store for the documentation links insert_links.py adds to code
+# blocks. file-link-cache.json stays the checked-in, reviewable copy of the
+# links; this SQLite index is built from it (and rebuilt whenever it changes)
+# so that a run only has to read the references for the files it looks at.
+#
+# Each file's entry also records a hash of the source it was resolved from
+# and the front-end version that resolved it, so that only files whose entry
+# is out of date need to be resolved again.
+
+EXPORT_PATH = "file-link-cache.json"
+INDEX_PATH = os.path.join(".cache", "file-link-index.sqlite")
+
+# Bump when the tables below change; older indexes are then rebuilt.
+SCHEMA_VERSION = 2
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, hash TEXT, version TEXT);
+CREATE TABLE IF NOT EXISTS refs (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    start_line INTEGER NOT NULL,
+    start_col INTEGER NOT NULL,
+    end_line INTEGER NOT NULL,
+    end_col INTEGER NOT NULL,
+    url TEXT NOT NULL,
+    PRIMARY KEY (path, seq)
+);
+CREATE INDEX IF NOT EXISTS refs_by_line ON refs (path, start_line);
+"""
+
+def export_text(entries):
+    # One reference per line, with files and references in a fixed order, so
+    # that regenerating links produces small, readable diffs.
+    # https://stackoverflow.com/a/72611442
+    ordered = dict()
+    for path in sorted(entries):
+        entry = entries[path]
+        ordered[path] = { key: entry[key] for key in ('hash', 'version') if entry.get(key) is not None }
+        ordered[path]['references'] = sorted(entry['references'], key=lambda x: x[0])
+    towrite = json.dumps(ordered, indent=2, ensure_ascii=False)
+    pat = re.compile(f'\n(  ){{3}}((  )+|(?=(}}|])))')
+    return pat.sub('', towrite) + "\n"
+
+class LinkIndex:
+    def __init__(self, index_path=INDEX_PATH, export_path=EXPORT_PATH):
+        self.index_path = index_path
+        self.export_path = export_path
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        # Several insert_links.py worker processes read the index at once.
+        self.db = sqlite3.connect(index_path, timeout=60)
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            with self.db:
+                for table in ('meta', 'files', 'refs'):
+                    self.db.execute("DROP TABLE IF EXISTS " + table)
+                self.db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        self.db.executescript(SCHEMA)
+
+    def _export_stamp(self):
+        try:
+            stat = os.stat(self.export_path)
+        except OSError:
+            return "missing"
+        return "{} {}".format(stat.st_mtime_ns, stat.st_size)
+
+    def _set_stamp(self):
+        self.db.execute("INSERT OR REPLACE INTO meta VALUES ('export', ?)", (self._export_stamp(),))
+
+    def refresh(self):
+        # Rebuild the index if the export was changed behind our back (by a
+        # pull, say). This is the only time the whole export is read.
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'export'").fetchone()
+        if row is not None and row[0] == self._export_stamp():
+            return False
+
+        entries = dict()
+        if os.path.exists(self.export_path):
+            with open(self.export_path, 'r', encoding='utf-8') as f:
+                content = json.load(f)
+            if isinstance(content, dict):
+                entries = content
+
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM refs")
+            self._insert(entries)
+            self._set_stamp()
+        return True
+
+    def _insert(self, entries):
+        for (path, entry) in entries.items():
+            self.db.execute("DELETE FROM refs WHERE path = ?", (path,))
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                            (path, entry.get('hash'), entry.get('version')))
+            self.db.executemany("INSERT INTO refs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(path, seq, start[0], start[1], end[0], end[1], url)
+                                 for (seq, ((start, end), url)) in enumerate(entry['references'])])
+
+    def lookup(self, path):
+        # Returns (hash, version, lines) for 'path', where 'lines' holds its
+        # references grouped by the line they start on, in the same
+        # [[start, end], url] form as the export. Returns None if the file has
+        # never been resolved. Entries written before hashes were recorded
+        # have None for both hash and version.
+        row = self.db.execute("SELECT hash, version FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None:
+            return None
+
+        lines = dict()
+        for (start_line, start_col, end_line, end_col, url) in self.db.execute(
+                "SELECT start_line, start_col, end_line, end_col, url FROM refs "
+                "WHERE path = ? ORDER BY start_line, start_col, end_line, end_col, seq", (path,)):
+            lines.setdefault(start_line, []).append([[[start_line, start_col], [end_line, end_col]], url])
+        return (row[0], row[1], lines)
+
+    def entries(self):
+        entries = { path: { 'hash': source_hash, 'version': version, 'references': [] }
+                    for (path, source_hash, version) in self.db.execute("SELECT path, hash, version FROM files") }
+        for (path, start_line, start_col, end_line, end_col, url) in self.db.execute(
+                "SELECT path, start_line, start_col, end_line, end_col, url FROM refs ORDER BY path, seq"):
+            entries[path]['references'].append([[[start_line, start_col], [end_line, end_col]], url])
+        return entries
+
+    def update(self, resolved):
+        # Store freshly resolved files and write out the new export. Picks up
+        # changes other runs made to the export first, so they aren't lost.
+        if not resolved: return
+        self.refresh()
+        with self.db:
+            self._insert(resolved)
+        write_file_atomically(self.export_path, export_text(self.entries()))
+        with self.db:
+            self._set_stamp()
+
+    def close(self):
+        self.db.close()
@@ -1,60 +1,145 @@
 #!/usr/bin/env python3
-import sys
-import re
+import argparse
+import concurrent.futures
+import glob
+import hashlib
 import os
+import re
+import sys
 from collections import defaultdict
 
-FILE_REGEX = r"^(\s*)```[a-zA-Z\-+_]+ {(.+)}$"
-END_REGEX = r"^(\s*)```$"
-
-file_name = sys.argv[1]
-base_dir = os.path.dirname(os.path.realpath(file_name))
-
-def error_and_exit(message):
-    raise Error(message)
-
-file_contents = defaultdict(lambda: [])
-with open(file_name) as file:
-    current_snippet = None
-    current_file = None
-    indent_string = None
-
-    for line in file:
-        file_match = re.match(FILE_REGEX, line)
-        end_match = re.match(END_REGEX, line)
-
-        if file_match is not None:
-            if current_file is not None:
-                error_and_exit("Starting a new file without finishing another!")
-
-            # Pieces can be either `key=value` or (maybe) just `attribute`
-            pieces = file_match[2].split(",")
-            for piece in pieces:
-                piece_assign = piece.split("=")
-                if len(piece_assign) != 2:
-                    # Weird syntax. Just look for other things.
-                    continue
-                (key, value) = piece_assign
-                if key == "file_name":
-                    current_file = value
-                    current_snippet = []
-                    indent_string = file_match[1]
-            continue
-        elif end_match is not None and current_file is not None:
-            indent_end_string = end_match[1]
-            if indent_string != indent_end_string:
-                error_and_exit("Inconsistent indentation in code blocks!")
-
-            file_contents[current_file].extend(current_snippet)
-
-            current_snippet = None
-            current_file = None
-            indent_string = None
-            continue
-        elif current_file is not None:
-            current_snippet.append(line.removeprefix(indent_string))
-
-for file in file_contents:
-    contents = file_contents[file]
-    with open(base_dir + "/" + file, "w") as file_outout:
-        file_outout.write("".join(contents))
+# Extracts the code blocks marked with {file_name=...} in Markdown-driven
+# articles into the named files, next to the Markdown file. Only files whose
+# contents change are written, and their paths are printed, so that callers
+# know which posts need rebuilding or retesting.
+
+FILE_REGEX = re.compile(r"^(\s*)```[a-zA-Z\-+_]+ {(.+)}$")
+END_REGEX = re.compile(r"^(\s*)```$")
+
+class MarkdownError(Exception):
+    def __init__(self, file_name, line_number, message):
+        super().__init__(message)
+        self.file_name = file_name
+        self.line_number = line_number
+        self.message = message
+
+    def __str__(self):
+        return "{}:{}: error: {}".format(self.file_name, self.line_number, self.message)
+
+def extract_files(file_name):
+    file_contents = defaultdict(lambda: [])
+    with open(file_name) as file:
+        current_snippet = None
+        current_file = None
+        current_start = None
+        indent_string = None
+
+        for (line_number, line) in enumerate(file, start=1):
+            # Neither pattern can match without a fence.
+            if "```" not in line:
+                if current_file is not None:
+                    current_snippet.append(line.removeprefix(indent_string))
+                continue
+
+            file_match = FILE_REGEX.match(line)
+            end_match = END_REGEX.match(line)
+
+            if file_match is not None:
+                if current_file is not None:
+                    raise MarkdownError(file_name, line_number,
+                                        "starting a new file without finishing the block for '{}' "
+                                        "(started on line {})".format(current_file, current_start))
+
+                # Pieces can be either `key=value` or (maybe) just `attribute`
+                pieces = file_match[2].split(",")
+                for piece in pieces:
+                    piece_assign = piece.split("=")
+                    if len(piece_assign) != 2:
+                        # Weird syntax. Just look for other things.
+                        continue
+                    (key, value) = piece_assign
+                    if key == "file_name":
+                        current_file = value
+                        current_start = line_number
+                        current_snippet = []
+                        indent_string = file_match[1]
+                continue
+            elif end_match is not None and current_file is not None:
+                indent_end_string = end_match[1]
+                if indent_string != indent_end_string:
+                    raise MarkdownError(file_name, line_number,
+                                        "inconsistent indentation in the block for '{}' "
+                                        "(started on line {})".format(current_file, current_start))
+
+                file_contents[current_file].extend(current_snippet)
+
+                current_snippet = None
+                current_file = None
+                indent_string = None
+                continue
+            elif current_file is not None:
+                current_snippet.append(line.removeprefix(indent_string))
+
+        if current_file is not None:
+            raise MarkdownError(file_name, current_start,
+                                "the block for '{}' is never closed".format(current_file))
+
+    return { name: "".join(contents) for (name, contents) in file_contents.items() }
+
+def write_if_changed(path, text):
+    data = text.encode()
+    try:
+        with open(path, "rb") as f:
+            if hashlib.sha256(f.read()).digest() == hashlib.sha256(data).digest():
+                return False
+    except FileNotFoundError:
+        pass
+    with open(path, "wb") as f:
+        f.write(data)
+    return True
+
+def process(file_name):
+    # Returns the files that changed, or the error that stopped us.
+    try:
+        outputs = extract_files(file_name)
+    except MarkdownError as e:
+        return ([], str(e))
+
+    base_dir = os.path.dirname(os.path.realpath(file_name))
+    changed = []
+    for (name, text) in outputs.items():
+        path = os.path.join(base_dir, name)
+        if write_if_changed(path, text):
+            changed.append(os.path.relpath(path))
+    return (changed, None)
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract code from Markdown-driven articles.")
+    parser.add_argument('files', help='Markdown files to extract code from', nargs='*')
+    parser.add_argument('--all', help='Extract code from every content/posts/*/index.md', action='store_true', default=False)
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help='Number of worker processes to use')
+    args = parser.parse_args()
+
+    files = list(args.files)
+    if args.all:
+        files += sorted(glob.glob(os.path.join("content", "posts", "*", "index.md")))
+    if not files:
+        parser.error("no Markdown files given; pass some files or --all")
+
+    if args.jobs <= 1 or len(files) == 1:
+        results = list(map(process, files))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            results = list(executor.map(process, files, chunksize=4))
+
+    failed = False
+    for (changed, error) in results:
+        for path in changed:
+            print(path)
+        if error is not None:
+            print(error, file=sys.stderr)
+            failed = True
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+import argparse
+import concurrent.futures
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from common import file_hasher, write_file_atomically
+
+# Makes smaller versions of the images in posts for the theme's figure
+# shortcode to offer browsers instead of the originals:
+#
+#   ./scripts/optimize_images.py
+#
+# Still images get WebP copies scaled to the widths in WIDTHS (about the
+# width of the text column, and twice that for high-density screens).
+# Animated GIFs get an MP4 video (if ffmpeg is installed) and an animated
+# WebP. A variant is only kept if it is smaller than the original.
+#
+# The variants go into image-gen/static, next to where Hugo puts the
+# original, and image-gen/data/images.json maps each original to its
+# variants. Both are mounted by config.toml. Variants are cached in
+# .cache/images by the hash of the original, so only new or changed images
+# are processed again.
+
+try:
+    from PIL import Image, ImageOps
+    HAVE_PILLOW = True
+except ImportError:
+    HAVE_PILLOW = False
+
+SOURCE_DIR = os.path.join("content", "posts")
+OUTPUT_DIR = "image-gen"
+CACHE_DIR = os.path.join(".cache", "images")
+EXTENSIONS = {".png", ".jpg", ".jpeg", ".gif"}
+
+WIDTHS = [720, 1440]
+WEBP_QUALITY = 80
+VIDEO_CRF = 23
+# Bump when the way variants are made changes, so cached ones are remade.
+VERSION = 1
+
+def have_ffmpeg():
+    return shutil.which("ffmpeg") is not None
+
+def settings(use_video):
+    return "{} {} {} {} {}".format(VERSION, WIDTHS, WEBP_QUALITY, VIDEO_CRF, use_video)
+
+def still_variants(im, name, out_dir):
+    im = ImageOps.exif_transpose(im)
+    if im.mode in ("P", "LA", "RGBA") or "transparency" in im.info:
+        im = im.convert("RGBA")
+    else:
+        im = im.convert("RGB")
+
+    (width, height) = im.size
+    variants = []
+    for w in [w for w in WIDTHS if w < width] + [width]:
+        scaled = im if w == width else im.resize((w, max(1, round(height * w / width))), Image.LANCZOS)
+        variant = "{}.{}w.webp".format(name, w)
+        scaled.save(os.path.join(out_dir, variant), "WEBP", quality=WEBP_QUALITY, method=6)
+        variants.append({ 'name': variant, 'type': 'image/webp', 'width': w })
+    return (width, height, variants)
+
+def animated_variants(im, src_path, name, out_dir, use_video):
+    (width, height) = im.size
+    variants = []
+    if use_video:
+        variant = name + ".mp4"
+        # H.264 in yuv420p needs even dimensions; faststart lets it begin
+        # playing before it has fully downloaded.
+        result = subprocess.run(["ffmpeg", "-v", "error", "-y", "-i", src_path,
+                                 "-movflags", "+faststart", "-pix_fmt", "yuv420p",
+                                 "-vf", "scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                                 "-c:v", "libx264", "-crf", str(VIDEO_CRF), "-an",
+                                 os.path.join(out_dir, variant)],
+                                capture_output=True, text=True)
+        if result.returncode == 0:
+            variants.append({ 'name': variant, 'type': 'video/mp4', 'width': width })
+        else:
+            print("Warning: ffmpeg could not convert {}: {}".format(src_path, result.stderr.strip()),
+                  file=sys.stderr)
+
+    # Mixing lossy and lossless frames and storing only what changed between
+    # frames is slow, but it's what gets screen recordings below GIF size.
+    variant = name + ".webp"
+    im.save(os.path.join(out_dir, variant), "WEBP", save_all=True, quality=WEBP_QUALITY,
+            method=2, allow_mixed=True, minimize_size=True)
+    variants.append({ 'name': variant, 'type': 'image/webp', 'width': width })
+    return (width, height, variants)
+
+def make_variants(src_path, out_dir, use_video):
+    name = os.path.basename(src_path)
+    with Image.open(src_path) as im:
+        if getattr(im, "is_animated", False):
+            (width, height, variants) = animated_variants(im, src_path, name, out_dir, use_video)
+        else:
+            (width, height, variants) = still_variants(im, name, out_dir)
+
+    size = os.path.getsize(src_path)
+    kept = []
+    for variant in variants:
+        path = os.path.join(out_dir, variant['name'])
+        variant['bytes'] = os.path.getsize(path)
+        if variant['bytes'] < size:
+            kept.append(variant)
+        else:
+            os.remove(path)
+    return { 'width': width, 'height': height, 'bytes': size, 'variants': kept }
+
+def optimize(src_path, cache_dir, use_video):
+    # Returns (manifest entry, cache directory holding the variants, whether
+    # they had to be made now).
+    h = file_hasher(src_path)
+    h.update(settings(use_video).encode())
+    key = h.hexdigest()
+    entry_dir = os.path.join(cache_dir, key[:2], key)
+    meta_path = os.path.join(entry_dir, "meta.json")
+
+    try:
+        with open(meta_path, encoding='utf-8') as f:
+            return (json.load(f), entry_dir, False)
+    except (OSError, ValueError):
+        pass
+
+    # Make the variants in a scratch directory and rename it into place, so
+    # an interrupted run never leaves a half-filled entry behind.
+    os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(entry_dir), suffix=".tmp")
+    try:
+        entry = make_variants(src_path, tmp_dir, use_video)
+        with open(os.path.join(tmp_dir, "meta.json"), 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        try:
+            os.replace(tmp_dir, entry_dir)
+        except OSError:
+            # Another worker made the variants of an identical image first.
+            if not os.path.exists(meta_path): raise
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return (entry, entry_dir, True)
+
+def find_images(source_dir):
+    for (dirpath, dirnames, filenames) in os.walk(source_dir):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() in EXTENSIONS:
+                yield os.path.join(dirpath, name)
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+def evict_unused(cache_dir, used):
+    if not os.path.isdir(cache_dir): return
+    for prefix in os.listdir(cache_dir):
+        for key in os.listdir(os.path.join(cache_dir, prefix)):
+            entry_dir = os.path.join(cache_dir, prefix, key)
+            if entry_dir not in used:
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+def optimize_all(source_dir=SOURCE_DIR, output_dir=OUTPUT_DIR, cache_dir=CACHE_DIR,
+                 jobs=None, use_video=True):
+    static_dir = os.path.join(output_dir, "static")
+    manifest_path = os.path.join(output_dir, "data", "images.json")
+    shutil.rmtree(static_dir, ignore_errors=True)
+
+    if not HAVE_PILLOW:
+        # Without variants the figure shortcode just uses the originals.
+        print("Warning: Pillow is not installed; not optimizing images", file=sys.stderr)
+        write_file_atomically(manifest_path, "{}\n")
+        return
+
+    use_video = use_video and have_ffmpeg()
+    paths = list(find_images(source_dir))
+    # Hugo serves content/posts/x/y.png as posts/x/y.png.
+    content_root = os.path.dirname(source_dir)
+
+    manifest = {}
+    used = set()
+    computed = 0
+    original_bytes = 0
+    optimized_bytes = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(optimize, paths, [cache_dir] * len(paths), [use_video] * len(paths))
+        for (path, (entry, entry_dir, made)) in zip(paths, results):
+            used.add(entry_dir)
+            computed += made
+            original_bytes += entry['bytes']
+            optimized_bytes += min([entry['bytes']] + [v['bytes'] for v in entry['variants']
+                                                       if v['width'] == entry['width']])
+            if not entry['variants']: continue
+
+            rel_path = os.path.relpath(path, content_root)
+            manifest[rel_path.replace(os.sep, "/")] = entry
+            dest_dir = os.path.join(static_dir, os.path.dirname(rel_path))
+            os.makedirs(dest_dir, exist_ok=True)
+            for variant in entry['variants']:
+                link_or_copy(os.path.join(entry_dir, variant['name']),
+                             os.path.join(dest_dir, variant['name']))
+
+    evict_unused(cache_dir, used)
+    write_file_atomically(manifest_path, json.dumps(manifest, indent=1, sort_keys=True) + "\n")
+    print("Optimized {} images ({} processed now, the rest cached): {:.1f} MB -> {:.1f} MB at full size"
+          .format(len(paths), computed, original_bytes / 1e6, optimized_bytes / 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description="Make smaller variants of the images in posts")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes to use')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Where to keep variants between builds')
+    parser.add_argument('--no-video', action='store_true', default=False,
+                        help="Don't convert animated GIFs to video, even if ffmpeg is available")
+    args = parser.parse_args()
+
+    optimize_all(cache_dir=args.cache_dir, jobs=args.jobs, use_video=not args.no_video)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import functools
+import os
+import subprocess
+import time
+from common import file_hasher, write_file_atomically
+
+# A persistent, content-addressed cache for the output of compiled blog
+# programs. Entries are keyed on everything that can influence what a program
+# prints: its source, the compopt/execopt pair, the compiler version, and the
+# CHPL_* environment.
+
+DEFAULT_CACHE_DIR = os.path.join(".cache", "chpl-output")
+DEFAULT_MAX_MB = 512
+DEFAULT_MAX_AGE_DAYS = 30
+
+@functools.cache
+def chpl_version():
+    try:
+        result = subprocess.run(['chpl', '--version'], capture_output=True,
+                                text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout
+
+def relevant_env():
+    return sorted((key, value) for (key, value) in os.environ.items()
+                  if key.startswith("CHPL_"))
+
+class OutputCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_MAX_MB,
+                 max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.max_age = max_age_days * 24 * 60 * 60
+
+    def key_for(self, file, compopt, execopt):
+        # Without a compiler version we can't tell whether a hit is stale, so
+        # don't use the cache at all.
+        version = chpl_version()
+        if version is None: return None
+
+        h = file_hasher(file)
+        for part in [compopt, execopt, version]:
+            h.update(b'\0' + part.encode())
+        for (key, value) in relevant_env():
+            h.update(b'\0' + key.encode() + b'=' + value.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".out")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                text = f.read()
+        except OSError:
+            return None
+
+        # Refresh the modification time so that eviction is least-recently-used.
+        try: os.utime(path)
+        except OSError: pass
+        return text
+
+    def put(self, key, text):
+        # Concurrent builds must never observe a partially-written entry.
+        write_file_atomically(self._path(key), text)
+
+    def evict(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.cache_dir):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        total = sum(size for (_, size, _) in entries)
+        removed = 0
+
+        # Oldest entries first; drop anything past the maximum age, then keep
+        # dropping until the cache fits in its size budget.
+        for (mtime, size, path) in sorted(entries):
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        if removed:
+            print("Evicted {} entries from output cache {}".format(removed, self.cache_dir))
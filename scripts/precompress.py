@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import os
+import shutil
+import sys
+from common import hash_file, write_file_atomically
+
+# Writes precompressed .gz (and, if the zstandard module is installed, .zst)
+# siblings for the text files in the built site, so that the web server can
+# send them as they are instead of compressing every response:
+#
+#   ./scripts/precompress.py --root public
+#
+# Run it last, after insert_links.py has finished rewriting pages. Compressed
+# files are kept in a cache keyed by the hash of their contents, so after a
+# rebuild only pages that actually changed are compressed again.
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+CACHE_DIR = os.path.join(".cache", "precompressed")
+DEFAULT_MIN_SIZE = 1024
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 19
+
+COMPRESSIBLE = {
+    ".html", ".css", ".js", ".json", ".xml", ".svg", ".txt", ".md",
+    ".chpl", ".c", ".h", ".py", ".good",
+}
+
+def compress_gzip(data):
+    # mtime=0 so that the same page always compresses to the same bytes.
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+def compress_zstd(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+def encodings(use_zstd):
+    result = [(".gz", "gz{}".format(GZIP_LEVEL), compress_gzip)]
+    if use_zstd:
+        result.append((".zst", "zst{}".format(ZSTD_LEVEL), compress_zstd))
+    return result
+
+def cache_path(cache_dir, key, tag):
+    return os.path.join(cache_dir, key[:2], "{}.{}".format(key, tag))
+
+def place(cached, target):
+    # The cached copy is never modified, so the site can share it.
+    if os.path.lexists(target):
+        os.remove(target)
+    try:
+        os.link(cached, target)
+    except OSError:
+        shutil.copyfile(cached, target)
+
+def precompress_file(path, cache_dir, use_zstd):
+    # Returns (original size, { suffix: compressed size or None }, cache
+    # files used, number of encodings that had to be computed). A sibling is
+    # only written when it is smaller than the original.
+    key = hash_file(path)
+    original_size = os.path.getsize(path)
+
+    # Only read the file if something has to be compressed.
+    data = None
+    sizes = {}
+    used = []
+    computed = 0
+    for (suffix, tag, compress) in encodings(use_zstd):
+        cached = cache_path(cache_dir, key, tag)
+        if not os.path.exists(cached):
+            if data is None:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            write_file_atomically(cached, compress(data))
+            computed += 1
+        used.append(cached)
+
+        size = os.path.getsize(cached)
+        if size < original_size:
+            place(cached, path + suffix)
+            sizes[suffix] = size
+        else:
+            if os.path.lexists(path + suffix):
+                os.remove(path + suffix)
+            sizes[suffix] = None
+    return (original_size, sizes, used, computed)
+
+def find_files(root, min_size):
+    for (dirpath, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if os.path.splitext(name)[1].lower() not in COMPRESSIBLE: continue
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path) or os.path.getsize(path) < min_size: continue
+            yield path
+
+def evict_unused(cache_dir, used):
+    # The cache only needs to hold what the current site uses.
+    for (dirpath, _, filenames) in os.walk(cache_dir):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            if path not in used:
+                os.remove(path)
+
+def report(stats, suffixes):
+    header = "{:<8} {:>6} {:>12}".format("type", "files", "bytes")
+    for suffix in suffixes:
+        header += " {:>12} {:>6}".format(suffix, "ratio")
+    print(header)
+    for ext in sorted(stats, key=lambda ext: -stats[ext]['bytes']):
+        row = stats[ext]
+        line = "{:<8} {:>6} {:>12}".format(ext, row['files'], row['bytes'])
+        for suffix in suffixes:
+            # Files that didn't compress are counted at their original size,
+            # since that is what gets sent.
+            ratio = "{:.2f}".format(row[suffix] / row['bytes']) if row['bytes'] else "-"
+            line += " {:>12} {:>6}".format(row[suffix], ratio)
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write precompressed copies of the text files in the built site")
+    parser.add_argument('--root', default='public', help='The built site')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes to use')
+    parser.add_argument('--min-size', type=int, default=DEFAULT_MIN_SIZE,
+                        help='Leave files smaller than this many bytes uncompressed')
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help='Where to keep compressed files between builds')
+    parser.add_argument('--no-zstd', action='store_true', default=False, help='Only write .gz files')
+    args = parser.parse_args()
+
+    use_zstd = HAVE_ZSTD and not args.no_zstd
+    if not HAVE_ZSTD and not args.no_zstd:
+        print("Warning: the zstandard module is not installed; only writing .gz files", file=sys.stderr)
+    suffixes = [suffix for (suffix, _, _) in encodings(use_zstd)]
+
+    paths = list(find_files(args.root, args.min_size))
+    stats = collections.defaultdict(lambda: collections.Counter())
+    used = set()
+    computed = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        results = executor.map(precompress_file, paths, [args.cache_dir] * len(paths),
+                               [use_zstd] * len(paths), chunksize=16)
+        for (path, (size, sizes, cached, n)) in zip(paths, results):
+            row = stats[os.path.splitext(path)[1].lower()]
+            row['files'] += 1
+            row['bytes'] += size
+            for suffix in suffixes:
+                row[suffix] += sizes[suffix] if sizes[suffix] is not None else size
+            used.update(cached)
+            computed += n
+
+    evict_unused(args.cache_dir, used)
+    report(stats, suffixes)
+    print("Precompressed {} files ({} compressed now, the rest reused from {})".format(len(paths), computed, args.cache_dir))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+import os
+import signal
+import subprocess
+import threading
+import time
+
+# Helpers for running the commands chpl_blog.py needs while generating
+# chunks: compiles can be cancelled, and program output is split into chunk
+# files as it is produced, with limits on how long a program may run and how
+# much it may print.
+
+# Programs that run longer than this many seconds are stopped, so that one
+# hung program can't stall the build; 0 means no limit.
+DEFAULT_RUN_TIMEOUT = int(os.environ.get("CHPL_BLOG_RUN_TIMEOUT", "600"))
+DEFAULT_MAX_CHUNK_KB = 1024
+DEFAULT_MAX_OUTPUT_MB = 16
+
+BREAK_LINE = b"__BREAK__"
+# Output is read a line at a time, but a program that never prints a newline
+# shouldn't make us buffer everything it prints.
+READ_LIMIT = 64 * 1024
+
+class BuildCancelled(Exception):
+    pass
+
+def check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise BuildCancelled()
+
+def kill_group(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+def wait_with_usage(proc, timeout, started, usage=None):
+    # Like proc.wait(timeout), but also records the child's wall time and
+    # resource usage into 'usage' (ru_maxrss is in kilobytes on Linux, bytes
+    # on macOS).
+    deadline = time.monotonic() + timeout
+    while proc.returncode is None:
+        (pid, status, rusage) = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            if usage is not None:
+                usage['child_wall_s'] = round(time.monotonic() - started, 3)
+                usage['child_user_s'] = round(rusage.ru_utime, 3)
+                usage['child_sys_s'] = round(rusage.ru_stime, 3)
+                usage['child_max_rss'] = rusage.ru_maxrss
+            break
+        if time.monotonic() >= deadline:
+            raise subprocess.TimeoutExpired(proc.args, timeout)
+        time.sleep(0.01)
+    return proc.returncode
+
+def run_command(cmd, cancel=None, stdout=None, usage=None):
+    # Like os.system, except that the command (and anything it spawned) is
+    # killed if 'cancel' is set before it finishes.
+    check_cancelled(cancel)
+    started = time.monotonic()
+    with subprocess.Popen(cmd, shell=True, stdout=stdout, start_new_session=True) as proc:
+        while True:
+            try:
+                return wait_with_usage(proc, 0.1, started, usage)
+            except subprocess.TimeoutExpired:
+                if cancel is not None and cancel.is_set():
+                    kill_group(proc)
+                    proc.wait()
+                    raise BuildCancelled()
+
+def failure_marker(reason):
+    return "\n*** Program output incomplete: {} ***\n".format(reason).encode()
+
+class ChunkWriter:
+    # Writes program output into output<suffix>.<i> files, starting a new
+    # file at each line consisting of just __BREAK__ (which is itself dropped).
+    def __init__(self, file_output_dir, suffix, max_chunk_bytes=None, max_total_bytes=None):
+        self.path_format = file_output_dir + "/output" + suffix + ".{}"
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_total_bytes = max_total_bytes
+        self.index = 0
+        self.chunk_bytes = 0
+        self.chunk_truncated = False
+        self.truncated = False
+        self.total_bytes = 0
+        self.at_line_start = True
+        self.captured = []
+        self.failure = None
+        self.out = open(self.path_format.format(0), 'wb')
+
+    def _next_chunk(self):
+        self.out.close()
+        self.index += 1
+        self.chunk_bytes = 0
+        self.chunk_truncated = False
+        self.out = open(self.path_format.format(self.index), 'wb')
+
+    def write(self, data):
+        if self.failure is not None: return
+
+        is_break = self.at_line_start and data in (BREAK_LINE + b"\n", BREAK_LINE)
+        self.at_line_start = data.endswith(b"\n")
+
+        self.total_bytes += len(data)
+        if self.max_total_bytes is not None and self.total_bytes > self.max_total_bytes:
+            self.failure = "exceeded {} bytes of output".format(self.max_total_bytes)
+            return
+        self.captured.append(data)
+
+        if is_break:
+            self._next_chunk()
+            return
+
+        if self.chunk_truncated: return
+        if self.max_chunk_bytes is not None and self.chunk_bytes + len(data) > self.max_chunk_bytes:
+            self.out.write(data[:self.max_chunk_bytes - self.chunk_bytes])
+            self.out.write(failure_marker("chunk exceeded {} bytes".format(self.max_chunk_bytes)))
+            self.chunk_truncated = True
+            self.truncated = True
+            return
+        self.out.write(data)
+        self.chunk_bytes += len(data)
+
+    def write_text(self, text):
+        for line in text.encode().splitlines(keepends=True):
+            self.write(line)
+
+    def text(self):
+        return b''.join(self.captured).decode(errors='replace')
+
+    def close(self, failure=None, expected_chunks=0):
+        # Mark the chunk we stopped in, and any chunks the program never got
+        # to, so that the post shows what went wrong instead of missing output.
+        failure = failure or self.failure
+        self.failure = failure
+        if failure is not None:
+            self.out.write(failure_marker(failure))
+            while self.index + 1 < expected_chunks:
+                self._next_chunk()
+                self.out.write(failure_marker(failure))
+        self.out.close()
+
+def _pump(pipe, writer):
+    while True:
+        data = pipe.readline(READ_LIMIT)
+        if not data: break
+        writer.write(data)
+
+def stream_program(cmd, writer, cancel=None, timeout=None, usage=None):
+    # Run 'cmd', feeding its output to 'writer' as it is produced. Returns the
+    # exit status, or None if the program had to be stopped; in that case the
+    # reason is left in writer.failure.
+    check_cancelled(cancel)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    status = None
+    started = time.monotonic()
+    with subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, start_new_session=True) as proc:
+        reader = threading.Thread(target=_pump, args=(proc.stdout, writer))
+        reader.start()
+        try:
+            while True:
+                try:
+                    status = wait_with_usage(proc, 0.1, started, usage)
+                    break
+                except subprocess.TimeoutExpired:
+                    pass
+                if cancel is not None and cancel.is_set():
+                    raise BuildCancelled()
+                if deadline is not None and time.monotonic() > deadline:
+                    writer.failure = "timed out after {} seconds".format(timeout)
+                    break
+                if writer.failure is not None:
+                    break
+        finally:
+            # Also takes care of anything the program left running in the
+            # background, which would otherwise keep the pipe open.
+            kill_group(proc)
+            reader.join()
+    return status if writer.failure is None else None
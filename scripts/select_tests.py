@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import sys
+import glob
+import argparse
+import subprocess
+from sub_test_help import REPO_ROOT, file_owner
+
+# Run start_test on just the tests affected by the changes since a git ref:
+#
+#   ./scripts/select_tests.py --since origin/main
+#
+# A post's tests are run when anything in its 'code' directory changes, or
+# when the 'chplVersion' in its 'index.md' does. Changes to a test's files in
+# 'chpl-src' select that test, and changes to files shared by the whole
+# directory select all of 'chpl-src'.
+
+CHPL_SRC = "chpl-src"
+POST_PATH = re.compile(r"content/posts/([^/]+)/(.*)")
+
+# changes to these could affect any test, so everything is run
+INFRASTRUCTURE = [
+    "Makefile",
+    "scripts/common.py",
+    "scripts/select_tests.py",
+    "scripts/sub_test_chpl_src.py",
+    "scripts/sub_test_content.py",
+    "scripts/sub_test_help.py",
+]
+
+def git(*args):
+    return subprocess.run(
+        ["git", *args], cwd=REPO_ROOT, check=True, capture_output=True, text=True
+    ).stdout
+
+# files changed (or added, or removed) since the merge base with 'since',
+# including uncommitted and untracked ones
+def changed_files(since):
+    base = git("merge-base", since, "HEAD").strip()
+    changed = set(git("diff", "--name-only", "--no-renames", "-z", base).split("\0"))
+    changed.update(git("ls-files", "--others", "--exclude-standard", "-z").split("\0"))
+    changed.discard("")
+    return base, sorted(changed)
+
+# the 'chplVersion' of a post at 'rev', or in the working tree if 'rev' is None
+def chpl_version_at(rev, path):
+    try:
+        if rev is None:
+            with open(os.path.join(REPO_ROOT, path)) as f:
+                text = f.read()
+        else:
+            text = git("show", rev + ":" + path)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r"chplVersion: (\S+)", text)
+    return match.group(1) if match else None
+
+def post_test_dirs():
+    return sorted(
+        os.path.relpath(path, REPO_ROOT)
+        for path in glob.glob(os.path.join(REPO_ROOT, "content", "posts", "*", "code"))
+    )
+
+# test directories can symlink files from elsewhere (chpl-src/MyAdd.c, for
+# example); map each target to the links that point to it
+def symlinks_by_target():
+    links = {}
+    for test_dir in [CHPL_SRC] + post_test_dirs():
+        for entry in os.scandir(os.path.join(REPO_ROOT, test_dir)):
+            if entry.is_symlink():
+                target = os.path.relpath(os.path.realpath(entry.path), REPO_ROOT)
+                links.setdefault(target, []).append(os.path.join(test_dir, entry.name))
+    return links
+
+# returns (post test directories, chpl-src tests), where the latter is None
+# when all of chpl-src should run; or None if everything should run
+def select(base, changed):
+    links = symlinks_by_target()
+    chpl_src_bases = [
+        name[:-len(".chpl")]
+        for name in os.listdir(os.path.join(REPO_ROOT, CHPL_SRC))
+        if name.endswith(".chpl")
+    ]
+    dirs = set()
+    chpl_src_tests = set()
+    chpl_src_all = False
+
+    for path in changed:
+        if path in INFRASTRUCTURE:
+            print("[{} changed, selecting all tests]".format(path))
+            return None
+
+        for affected in [path] + links.get(path, []):
+            if affected.startswith(CHPL_SRC + "/"):
+                name = affected[len(CHPL_SRC) + 1:]
+                owner = None if "/" in name else file_owner(name, chpl_src_bases)
+                if owner is None:
+                    chpl_src_all = True
+                else:
+                    chpl_src_tests.add(CHPL_SRC + "/" + owner + ".chpl")
+            elif (match := POST_PATH.fullmatch(affected)) is not None:
+                post, rest = match.groups()
+                code_dir = "content/posts/{}/code".format(post)
+                if not os.path.isdir(os.path.join(REPO_ROOT, code_dir)):
+                    continue
+                if rest.startswith("code/"):
+                    dirs.add(code_dir)
+                elif rest == "index.md" and chpl_version_at(base, affected) != chpl_version_at(None, affected):
+                    dirs.add(code_dir)
+
+    if chpl_src_all:
+        return sorted(dirs), None
+    return sorted(dirs), sorted(chpl_src_tests)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run start_test on the tests affected by changes since a git ref",
+        epilog="Any other arguments are passed on to start_test.",
+    )
+    parser.add_argument("--since", default="origin/main", help="Git ref to compare against (default: origin/main)")
+    parser.add_argument("--list", action="store_true", default=False, help="Only list the selected tests")
+    args, start_test_args = parser.parse_known_args()
+
+    base, changed = changed_files(args.since)
+    selection = select(base, changed)
+    env = os.environ.copy()
+
+    if selection is None:
+        dirs = [CHPL_SRC] + post_test_dirs()
+    else:
+        dirs, chpl_src_tests = selection
+        if chpl_src_tests is None:
+            dirs = [CHPL_SRC] + dirs
+        elif chpl_src_tests:
+            dirs = [CHPL_SRC] + dirs
+            env["CHPL_SUB_TEST_ONLY"] = ",".join(chpl_src_tests)
+            for test in chpl_src_tests:
+                print("[Selected {}]".format(test))
+
+    if not dirs:
+        print("[No tests affected by changes since {}]".format(args.since))
+        return 0
+    for test_dir in dirs:
+        print("[Selected {}]".format(test_dir))
+    sys.stdout.flush()
+
+    if args.list:
+        return 0
+    return subprocess.run(["start_test", *start_test_args, *dirs], cwd=REPO_ROOT, env=env).returncode
+
+if __name__ == "__main__":
+    exit(main())
@@ -4,16 +4,43 @@ import os
 import sys
 import subprocess
 import re
+import json
+import time
+import hashlib
+import functools
 import concurrent.futures
 from packaging import version
+from common import read_options_file, write_file_atomically
+
+# how long each test took last time, so that the slowest tests can start first
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DURATIONS_PATH = os.path.join(REPO_ROOT, ".cache", "sub-test-durations.json")
+
+# with CHPL_SUB_TEST_CACHE set, the inputs of each test that passed, so that
+# it can be skipped until something it depends on changes
+RESULTS_PATH = os.path.join(REPO_ROOT, ".cache", "sub-test-results.json")
+
+# environment variables that control this script rather than the tests
+CONTROL_VARS = [
+    "CHPL_ONETEST",
+    "CHPL_PARALLEL_SUB_TEST",
+    "CHPL_SUB_TEST_CORES",
+    "CHPL_SUB_TEST_CACHE",
+    "CHPL_SUB_TEST_FORCE",
+    "CHPL_SUB_TEST_ONLY",
+]
+
+@functools.cache
+def chpl_version_output(compiler):
+    return subprocess.run([compiler, "--version"], capture_output=True, text=True).stdout
 
 # get the current Chapel version at $CHPL_HOME
 def get_current_chpl_version(compiler):
     if "CHPL_HOME" not in os.environ:
         print("Please set 'CHPL_HOME' and try again")
         exit(1)
-    version_stdout = subprocess.run([compiler, "--version"], capture_output=True, text=True)
-    return version.parse(re.search(r"chpl version (\d+\.\d+\.\d+)", version_stdout.stdout).group(1))
+    version_stdout = chpl_version_output(compiler)
+    return version.parse(re.search(r"chpl version (\d+\.\d+\.\d+)", version_stdout).group(1))
 
 # return a list of paths to all the '.chpl' files in a directory
 def chpl_files_in_dir(dir):
@@ -53,8 +80,178 @@ def run_sub_test_on_file(chpl_home_subtest, compiler, src_file):
     )
     return p.returncode, p.stdout
 
+def timed_sub_test_on_file(chpl_home_subtest, compiler, src_file):
+    start = time.monotonic()
+    returncode, output = run_sub_test_on_file(chpl_home_subtest, compiler, src_file)
+    return src_file, returncode, output, time.monotonic() - start
+
+# tests are keyed relative to the repository root, so that 'chpl-src' and the
+# code directory of each post share one history
+def test_key(src_file):
+    return os.path.relpath(os.path.abspath(src_file), REPO_ROOT)
+
+def load_durations():
+    try:
+        with open(DURATIONS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_durations(new_durations):
+    # other test directories may have recorded durations since we loaded them
+    durations = load_durations()
+    durations.update(new_durations)
+    write_file_atomically(DURATIONS_PATH, json.dumps(durations, indent=2, sort_keys=True))
+
+# list the regular files in a directory, minus the ones its tests generate
+@functools.cache
+def test_dir_files(dirpath):
+    names = sorted(
+        name for name in os.listdir(dirpath)
+        if os.path.isfile(os.path.join(dirpath, name)) and not name.startswith(".")
+    )
+    generated = set()
+    for name in names:
+        if name == "CLEANFILES" or name.endswith(".cleanfiles"):
+            with open(os.path.join(dirpath, name)) as f:
+                generated.update(line.strip() for line in f if line.strip())
+    return [
+        name for name in names
+        if name not in generated and not name.endswith((".tmp", ".bad"))
+    ]
+
+# which test a file in a test directory belongs to, or None if it is shared
+# by the whole directory; a name like 'a.b.good' belongs to 'a.b.chpl' rather
+# than 'a.chpl'
+def file_owner(name, bases):
+    owners = [b for b in bases if name.startswith(b + ".")]
+    return max(owners, key=len) if owners else None
+
+# the files a test reads: its own (foo.chpl, foo.good, foo.compopts, ...) and
+# any in its directory that don't belong to another test (COMPOPTS, helper C
+# sources, data files, ...)
+def test_inputs(src_file):
+    dirpath = os.path.dirname(src_file) or "."
+    names = test_dir_files(dirpath)
+    bases = [name[:-len(".chpl")] for name in names if name.endswith(".chpl")]
+    base = os.path.basename(src_file)[:-len(".chpl")]
+
+    inputs = []
+    for name in names:
+        owner = file_owner(name, bases)
+        if owner is None:
+            # compiled programs are named after their tests
+            if name in bases or name.removesuffix("_real") in bases:
+                continue
+        elif owner != base:
+            continue
+        inputs.append(os.path.join(dirpath, name))
+    return inputs
+
+def test_input_hash(compiler, src_file):
+    h = hashlib.sha256()
+    h.update(chpl_version_output(compiler).encode())
+    for key, value in sorted(os.environ.items()):
+        if key.startswith("CHPL_") and key not in CONTROL_VARS:
+            h.update(b"\0" + key.encode() + b"=" + value.encode())
+    for path in test_inputs(src_file):
+        h.update(b"\0" + os.path.basename(path).encode() + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def load_results():
+    try:
+        with open(RESULTS_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_results(new_results):
+    results = load_results()
+    for key, input_hash in new_results.items():
+        if input_hash is None:
+            results.pop(key, None)
+        else:
+            results[key] = input_hash
+    write_file_atomically(RESULTS_PATH, json.dumps(results, indent=2, sort_keys=True))
+
+# sub_test's exit code doesn't say whether the test itself passed
+def test_passed(returncode, output):
+    return returncode == 0 and "[Success" in output and "[Error" not in output
+
+def env_flag(name):
+    return os.environ.get(name, "") not in ("", "0", "false", "no")
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+# the comm layer tests run with, which may come from chplconfig or the
+# platform's default rather than CHPL_COMM; if chplenv can't tell us, assume
+# a multi-locale one, since overcounting cores only costs parallelism
+@functools.cache
+def chpl_comm():
+    script = os.path.join(os.environ.get("CHPL_HOME", ""), "util", "chplenv", "chpl_comm.py")
+    try:
+        p = subprocess.run([sys.executable, script], capture_output=True, text=True)
+        if p.returncode == 0 and p.stdout.strip():
+            return p.stdout.strip()
+    except OSError:
+        pass
+    return os.environ.get("CHPL_COMM", "unknown")
+
+# the cores a test will keep busy: one per locale (or, if the test's
+# environment sets CHPL_RT_NUM_THREADS_PER_LOCALE, that many per locale), for
+# the largest number of locales it runs with
+def test_cores(src_file):
+    base = src_file[:-len(".chpl")]
+    dirpath = os.path.dirname(src_file) or "."
+
+    locales = 1
+    if chpl_comm() != "none":
+        for options_file in [base + ".numlocales", os.path.join(dirpath, "NUMLOCALES")]:
+            if os.path.exists(options_file):
+                counts = [int(line) for line in read_options_file(options_file) if line.strip().isdigit()]
+                locales = max(counts, default=1)
+                break
+
+    threads = os.environ.get("CHPL_RT_NUM_THREADS_PER_LOCALE")
+    for options_file in [os.path.join(dirpath, "EXECENV"), base + ".execenv"]:
+        if not os.path.exists(options_file):
+            continue
+        try:
+            lines = read_options_file(options_file)
+        except (OSError, subprocess.CalledProcessError):
+            continue
+        for line in lines:
+            key, _, value = line.strip().partition("=")
+            if key == "CHPL_RT_NUM_THREADS_PER_LOCALE":
+                threads = value
+    try:
+        threads = max(1, int(threads)) if threads else 1
+    except ValueError:
+        threads = 1
+
+    return locales * threads
+
+def core_budget():
+    budget_env = os.environ.get("CHPL_SUB_TEST_CORES", str(available_cores()))
+    try:
+        budget = int(budget_env)
+        if budget < 1:
+            raise ValueError
+        return budget
+    except ValueError:
+        print(
+            f"Invalid value for CHPL_SUB_TEST_CORES: '{budget_env}'. Must be a positive integer."
+        )
+        exit(1)
+
 def parallel_workers():
-    workers_env = os.environ.get("CHPL_PARALLEL_SUB_TEST", "1")
+    workers_env = os.environ.get("CHPL_PARALLEL_SUB_TEST", str(available_cores()))
     try:
         workers = int(workers_env)
         if workers < 1:
@@ -88,19 +285,90 @@ def run_valid_tests(version_validator, compiler):
             if version_validator(src_file, chpl_version)
         ]
 
+        # select_tests.py can limit a directory to some of its tests, given
+        # as paths from the repository root; other directories run in full
+        if only := os.environ.get("CHPL_SUB_TEST_ONLY"):
+            selected = set(only.split(","))
+            if any(os.path.dirname(test) == test_key(".") for test in selected):
+                valid_files = [f for f in valid_files if test_key(f) in selected]
+
         num_workers = parallel_workers()
 
+        # start the longest tests first (and tests we haven't timed yet, which
+        # might be the longest of all), so that they don't end up running
+        # alone at the end
+        durations = load_durations()
+        valid_files.sort(
+            key=lambda src_file: durations.get(test_key(src_file), float("inf")),
+            reverse=True,
+        )
+        new_durations = {}
+
+        # opt-in: skip tests whose inputs haven't changed since they last
+        # passed (CHPL_SUB_TEST_FORCE runs them anyway)
+        use_cache = env_flag("CHPL_SUB_TEST_CACHE")
+        input_hashes = {}
+        new_results = {}
+        if use_cache:
+            passed = {} if env_flag("CHPL_SUB_TEST_FORCE") else load_results()
+            to_run = []
+            for src_file in valid_files:
+                input_hashes[src_file] = test_input_hash(sys.argv[1], src_file)
+                if passed.get(test_key(src_file)) == input_hashes[src_file]:
+                    sys.stdout.write(
+                        "[Success matching program output for {} (cached: unchanged since it last passed)]\n".format(src_file)
+                    )
+                else:
+                    to_run.append(src_file)
+            sys.stdout.flush()
+            valid_files = to_run
+
+        # besides the limit on how many tests run at once, each test is
+        # charged for the cores it uses against a budget; a test that needs
+        # more than the whole budget runs on its own
+        budget = core_budget()
+        cores = {src_file: min(test_cores(src_file), budget) for src_file in valid_files}
+        free_cores = budget
+        pending = list(valid_files)
+        running = {}
+
         with concurrent.futures.ThreadPoolExecutor(max_workers=num_workers) as executor:
-            # forward on 'compiler' argument from sys.argv
-            results = executor.map(
-                lambda src_file: run_sub_test_on_file(
-                    chpl_home_subtest, sys.argv[1], src_file
-                ),
-                valid_files,
-            )
-            for returncode, output in results:
-                sys.stdout.write(output)
-                sys.stdout.flush()
-                err = max(err, returncode)
+            while pending or running:
+                # start tests in order while they fit; when one has to wait
+                # for cores, smaller tests behind it can use what's left
+                for src_file in list(pending):
+                    if len(running) >= num_workers:
+                        break
+                    if cores[src_file] > free_cores:
+                        continue
+                    pending.remove(src_file)
+                    free_cores -= cores[src_file]
+                    # forward on 'compiler' argument from sys.argv
+                    future = executor.submit(
+                        timed_sub_test_on_file, chpl_home_subtest, sys.argv[1], src_file
+                    )
+                    running[future] = src_file
+
+                # report each test as soon as it finishes
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    free_cores += cores[running.pop(future)]
+                    src_file, returncode, output, elapsed = future.result()
+                    sys.stdout.write(output)
+                    sys.stdout.write(
+                        "[Elapsed time for sub_test on {}: {:.3f} seconds]\n".format(src_file, elapsed)
+                    )
+                    sys.stdout.flush()
+                    new_durations[test_key(src_file)] = round(elapsed, 3)
+                    if use_cache:
+                        new_results[test_key(src_file)] = (
+                            input_hashes[src_file] if test_passed(returncode, output) else None
+                        )
+                    err = max(err, returncode)
 
+        save_durations(new_durations)
+        if use_cache:
+            save_results(new_results)
         exit(err)
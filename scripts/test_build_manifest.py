@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+import build_manifest
+from build_manifest import BuildManifest
+
+# Run with: python3 -m unittest discover scripts
+
+class BuildManifestTest(unittest.TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dir = tmp.name
+        self.file = os.path.join(self.dir, "post.chpl")
+        with open(self.file, "w") as f:
+            f.write('writeln("hello");\n')
+        self.output_dir = os.path.join(self.dir, "post")
+        os.makedirs(self.output_dir)
+        open(os.path.join(self.output_dir, "index.md"), "w").close()
+        self.manifest_path = os.path.join(self.dir, "manifest.json")
+
+        # generator_version() hashes literate_chapel, which needs CHPL_HOME.
+        patcher = mock.patch.object(build_manifest, "generator_version", return_value="gen")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def record_with(self, version, env, chunks=True):
+        with mock.patch("output_cache.chpl_version", return_value=version), \
+             mock.patch("output_cache.relevant_env", return_value=sorted(env.items())):
+            manifest = BuildManifest(self.manifest_path)
+            manifest.record(self.file, manifest.entry_for(self.file, chunks))
+            manifest.save()
+
+    def is_current_with(self, version, env, chunks=True):
+        with mock.patch("output_cache.chpl_version", return_value=version), \
+             mock.patch("output_cache.relevant_env", return_value=sorted(env.items())):
+            # A fresh manifest, as on the next run of chpl_blog.py.
+            manifest = BuildManifest(self.manifest_path)
+            return manifest.is_current(self.file, manifest.entry_for(self.file, chunks),
+                                       self.output_dir)
+
+    def test_unchanged_is_current(self):
+        env = {"CHPL_COMM": "none"}
+        self.record_with("chpl version 2.5.0", env)
+        self.assertTrue(self.is_current_with("chpl version 2.5.0", env))
+
+    def test_new_compiler_version_rebuilds(self):
+        env = {"CHPL_COMM": "none"}
+        self.record_with("chpl version 2.5.0", env)
+        self.assertFalse(self.is_current_with("chpl version 2.6.0", env))
+
+    def test_new_environment_rebuilds(self):
+        self.record_with("chpl version 2.5.0", {"CHPL_COMM": "none"})
+        self.assertFalse(self.is_current_with("chpl version 2.5.0", {"CHPL_COMM": "gasnet"}))
+
+    def test_compiler_ignored_without_chunks(self):
+        # Without program output, the compiler doesn't affect the post.
+        self.record_with("chpl version 2.5.0", {}, chunks=False)
+        self.assertTrue(self.is_current_with("chpl version 2.6.0", {}, chunks=False))
+
+if __name__ == "__main__":
+    unittest.main()